@@ -21,7 +21,8 @@ from pumpkinlb import __version__ as pumpkin_version
 from pumpkinlb.config import PumpkinConfig, PumpkinMapping, PumpkinConfigException
 from pumpkinlb.usage import printUsage, printConfigHelp, getVersionStr
 from pumpkinlb.listener import PumpkinListener
-from pumpkinlb.constants import GRACEFUL_SHUTDOWN_TIME
+from pumpkinlb.udp import PumpkinUDPListener
+from pumpkinlb.constants import GRACEFUL_SHUTDOWN_TIME, STARTUP_READY_TIMEOUT
 
 from pumpkinlb.log import logmsg, logerr
 
@@ -53,6 +54,8 @@ if __name__ == '__main__':
         printUsage(sys.stderr)
         sys.exit(1)
 
+    startupTime = time.time()
+
     pumpkinConfig = PumpkinConfig(configFilename)
     try:
         pumpkinConfig.parse()
@@ -70,11 +73,60 @@ if __name__ == '__main__':
 
     mappings = pumpkinConfig.getMappings()
     listeners = []
+
+    # Create every TLS context before forking anything: every listener and worker then shares the same session ticket keys,
+    #  and a bad certificate on any mapping stops us before there are listeners to clean up.
+    for mappingAddr, mapping in mappings.items():
+        if mapping.tls is None:
+            continue
+        try:
+            mapping.tls.getServerContext()
+            mapping.tls.getClientContext()
+        except Exception as e:
+            logerr('Failed to set up TLS for %s: %s\n' %(mappingAddr, str(e)))
+            sys.exit(1)
+        logmsg('TLS enabled for %s: %s\n' %(mappingAddr, repr(mapping.tls)))
+
+    # Start every listener before waiting on any of them, so they bind concurrently
+    spawnStartTime = time.time()
     for mappingAddr, mapping in mappings.items():
-        logmsg('Starting up listener on %s:%d with mappings: %s\n' %(mapping.localAddr, mapping.localPort, str(mapping.workers)))
-        listener = PumpkinListener(mapping.localAddr, mapping.localPort, mapping.workers, bufferSize)
+        logmsg('Starting up %s listener on %s:%d with mappings: %s\n' %(mapping.protocol, mapping.localAddr, mapping.localPort, str(mapping.workers)))
+        if mapping.protocol == 'udp':
+            listener = PumpkinUDPListener(mapping.localAddr, mapping.localPort, mapping.workers, pumpkinConfig.getOptions())
+        else:
+            listener = PumpkinListener(mapping.localAddr, mapping.localPort, mapping.workers, bufferSize, pumpkinConfig.getOptions(), mapping.tls)
         listener.start()
         listeners.append(listener)
+    spawnEndTime = time.time()
+
+    def handleSigUsr(signum, *args):
+        # Pass SIGUSR1 (dump state) and SIGUSR2 (toggle profiling) on to every listener
+        for listener in listeners:
+            try:
+                os.kill(listener.pid, signum)
+            except:
+                pass
+
+    # Before waiting on the listeners, so a signal during startup doesn't kill us (their default action) and orphan them
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handleSigUsr)
+        signal.signal(signal.SIGUSR2, handleSigUsr)
+
+    readyDeadline = spawnEndTime + STARTUP_READY_TIMEOUT
+    notReady = []
+    for listener in listeners:
+        if not listener.readyEvent.wait(max(readyDeadline - time.time(), 0)):
+            notReady.append(listener)
+    readyTime = time.time()
+
+    if notReady:
+        logerr('WARNING: %d listener(s) not yet bound after %d seconds, they will keep retrying: %s\n' %(len(notReady), STARTUP_READY_TIMEOUT, ', '.join(['%s:%d' %(listener.localAddr, listener.localPort) for listener in notReady])))
+
+    configTimings = pumpkinConfig.getTimings()
+    logmsg('Startup timing: config %.3fs (DNS resolution %.3fs for %d hosts), spawn %.3fs for %d listeners, bind %.3fs, total %.3fs\n' %(
+        configTimings.get('parse', 0), configTimings.get('resolve', 0), configTimings.get('resolve_count', 0),
+        spawnEndTime - spawnStartTime, len(listeners), readyTime - spawnEndTime, readyTime - startupTime)
+    )
 
 
     globalIsTerminating = False
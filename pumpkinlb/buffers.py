@@ -0,0 +1,97 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import multiprocessing
+
+from .constants import DEFAULT_BUFFER_HIGH_WATERMARK, DEFAULT_BUFFER_LOW_WATERMARK
+
+# Indexes into PumpkinBufferLimits._state
+_USED_BYTES = 0
+_WATERMARK_PAUSES = 1
+_BUDGET_PAUSES = 2
+
+
+class PumpkinBufferLimits(object):
+    '''
+        Holds the backpressure settings for a single listener, and the state shared between its worker processes.
+
+          highWatermark / lowWatermark - A worker stops reading from one side of a connection once the data pending
+            for the other side reaches highWatermark, and resumes once it has drained to lowWatermark.
+
+          memoryBudget - The total number of bytes which may be buffered across every connection on the listener.
+            0 is unlimited, in which case no accounting is done.
+
+        Also counts how often each kind of backpressure kicks in.
+    '''
+
+    def __init__(self, highWatermark=DEFAULT_BUFFER_HIGH_WATERMARK, lowWatermark=DEFAULT_BUFFER_LOW_WATERMARK, memoryBudget=0):
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.memoryBudget = memoryBudget
+
+        self._state = multiprocessing.RawArray('q', 3)
+        self._lock = multiprocessing.Lock()
+
+    def reserve(self, amount):
+        '''
+            reserve - Reserve up to "amount" bytes of the memory budget. Returns the number reserved, which may be 0.
+        '''
+        if not self.memoryBudget:
+            return amount
+        with self._lock:
+            state = self._state
+            granted = min(amount, self.memoryBudget - state[_USED_BYTES])
+            if granted <= 0:
+                return 0
+            state[_USED_BYTES] += granted
+            return granted
+
+    def release(self, amount):
+        '''
+            release - Return "amount" previously reserved bytes to the memory budget
+        '''
+        if not self.memoryBudget or amount <= 0:
+            return
+        with self._lock:
+            self._state[_USED_BYTES] -= amount
+
+    def isExhausted(self):
+        if not self.memoryBudget:
+            return False
+        return self._state[_USED_BYTES] >= self.memoryBudget
+
+    def _increment(self, idx):
+        with self._lock:
+            self._state[idx] += 1
+
+    def countWatermarkPause(self):
+        self._increment(_WATERMARK_PAUSES)
+
+    def countBudgetPause(self):
+        self._increment(_BUDGET_PAUSES)
+
+    def getStats(self):
+        '''
+            getStats - Returns a dict of the current buffered bytes and backpressure counters
+
+              Reads without the lock, as this is called from signal handlers (SIGUSR1, SIGTERM) which may interrupt
+                a thread holding it. Each counter is read atomically, they just may not all be from the same instant.
+        '''
+        state = self._state
+        return {
+            'buffered_bytes'   : state[_USED_BYTES],
+            'watermark_pauses' : state[_WATERMARK_PAUSES],
+            'budget_pauses'    : state[_BUDGET_PAUSES],
+        }
+
+    @classmethod
+    def fromOptions(cls, options):
+        return cls(
+            options.get('buffer_high_watermark', DEFAULT_BUFFER_HIGH_WATERMARK),
+            options.get('buffer_low_watermark', DEFAULT_BUFFER_LOW_WATERMARK),
+            options.get('buffer_memory_budget', 0),
+        )
+
+# vim: set ts=4 sw=4 expandtab
@@ -3,31 +3,38 @@
 #
 # See: https://github.com/kata198/PumpkinLB
 
+import os
+import re
 import sys
-import socket
+import time
 try:
     from ConfigParser import ConfigParser
 except:
     from configparser import ConfigParser
 
-from .constants import DEFAULT_BUFFER_SIZE
+from .constants import DEFAULT_BUFFER_SIZE, DEFAULT_CLIENT_RATE_SLOTS, DEFAULT_BUFFER_HIGH_WATERMARK, DEFAULT_BUFFER_LOW_WATERMARK, DEFAULT_RESOLVE_TIMEOUT, DEFAULT_INSTRUMENT_SAMPLE, DEFAULT_UDP_IDLE_TIMEOUT, DEFAULT_UDP_MAX_FLOWS, DEFAULT_SPILLOVER_FAILURE_RATE, DEFAULT_SPILLOVER_RETRY_INTERVAL
 from .log import logmsg, logerr
+from .resolve import resolveHostnames
+from .tls import PumpkinTLSConfig, isTLSAvailable
 
 class PumpkinMapping(object):
     '''
         Represents a mapping of a local listen to a series of workers
     '''
 
-    def __init__(self, localAddr, localPort, workers):
+    def __init__(self, localAddr, localPort, workers, protocol='tcp'):
         self.localAddr = localAddr or ''
         self.localPort = int(localPort)
         self.workers = workers
+        self.protocol = protocol # "tcp" or "udp"
+
+        self.tls = None # PumpkinTLSConfig, if this mapping has a [tls:...] section
 
     def getListenerArgs(self):
         return [self.localAddr, self.localPort, self.workers]
 
-    def addWorker(self, workerAddr, workerPort):
-        self.workers.append( {'port' : int(workerPort), 'addr' : workerAddr} )
+    def addWorker(self, workerAddr, workerPort, tier=0):
+        self.workers.append( {'port' : int(workerPort), 'addr' : workerAddr, 'tier' : int(tier)} )
 
     def removeWorker(self, workerAddr, workerPort):
         newWorkers = []
@@ -49,15 +56,52 @@ class PumpkinConfig(ConfigParser):
 
     
     def __init__(self, configFilename):
-        ConfigParser.__init__(self)
+        # Only "=" separates a key from its value, so that keys like "192.168.1.100:80" or "udp:53" stay whole
+        try:
+            ConfigParser.__init__(self, delimiters=('=',))
+        except TypeError:
+            # python2 ConfigParser has no "delimiters"
+            ConfigParser.__init__(self)
+            self.OPTCRE = re.compile(r'(?P<option>[^=\s][^=]*)\s*(?P<vi>[=])\s*(?P<value>.*)$')
         self.configFilename = configFilename
 
         self._options = {
             'pre_resolve_workers' : True,
+            'resolve_timeout'     : DEFAULT_RESOLVE_TIMEOUT,
             'buffer_size'         : DEFAULT_BUFFER_SIZE,
+
+            # Rate limits, 0 is unlimited
+            'client_rate_bytes'        : 0,
+            'client_rate_connections'  : 0,
+            'client_rate_slots'        : DEFAULT_CLIENT_RATE_SLOTS,
+            'mapping_rate_bytes'       : 0,
+            'mapping_rate_connections' : 0,
+            'backend_rate_bytes'       : 0,
+            'backend_rate_connections' : 0,
+
+            # Backpressure
+            'buffer_high_watermark'    : DEFAULT_BUFFER_HIGH_WATERMARK,
+            'buffer_low_watermark'     : DEFAULT_BUFFER_LOW_WATERMARK,
+            'buffer_memory_budget'     : 0,
+
+            # Instrumentation
+            'instrument'               : False,
+            'instrument_sample'        : DEFAULT_INSTRUMENT_SAMPLE,
+            'profile_dir'              : None,
+
+            # Backend tiers
+            'spillover_connections'    : 0,
+            'spillover_failure_rate'   : DEFAULT_SPILLOVER_FAILURE_RATE,
+            'spillover_retry_interval' : DEFAULT_SPILLOVER_RETRY_INTERVAL,
+
+            # UDP mappings
+            'udp_idle_timeout'         : DEFAULT_UDP_IDLE_TIMEOUT,
+            'udp_max_flows'            : DEFAULT_UDP_MAX_FLOWS,
         }
         self._mappings = {}
 
+        self._timings = {}
+
     def parse(self):
         '''
             Parse the config file
@@ -67,12 +111,16 @@ class PumpkinConfig(ConfigParser):
         except IOError as e:
             logerr('Could not open config file: "%s": %s\n' %(self.configFilename, str(e)))
             raise e
+        startTime = time.time()
         [self.remove_section(s) for s in self.sections()]
         self.readfp(f)
         f.close()
 
         self._processOptions()
+        self._timings['read'] = time.time() - startTime
         self._processMappings()
+        self._processTLS()
+        self._timings['parse'] = time.time() - startTime
 
     def getOptions(self):
         '''
@@ -93,6 +141,14 @@ class PumpkinConfig(ConfigParser):
         '''
         return self._mappings
 
+    def getTimings(self):
+        '''
+            getTimings - Gets a dictionary of how long (in seconds) each phase of the last parse took:
+              "read" (reading the file and options), "resolve" (DNS pre-resolution of workers), and "parse" (total).
+              "resolve_count" is the number of distinct worker hostnames which were resolved.
+        '''
+        return self._timings
+
     def _processOptions(self):
         # I personally think the config parser interface sucks...
         if 'options' not in self._sections:
@@ -118,6 +174,62 @@ class PumpkinConfig(ConfigParser):
         except Exception as e:
             logerr('Error parsing [options]->buffer_size : %s. Retaining default, %s\n' %(str(e),str(DEFAULT_BUFFER_SIZE)) )
 
+        for optionName in ('client_rate_bytes', 'client_rate_connections', 'mapping_rate_bytes', 'mapping_rate_connections', 'backend_rate_bytes', 'backend_rate_connections'):
+            self._processIntOption(optionName, 0)
+        self._processIntOption('client_rate_slots', 1)
+
+        self._processIntOption('resolve_timeout', 1)
+
+        self._processIntOption('buffer_high_watermark', 1)
+        self._processIntOption('buffer_low_watermark', 0)
+        self._processIntOption('buffer_memory_budget', 0)
+        if self._options['buffer_low_watermark'] > self._options['buffer_high_watermark']:
+            logerr('WARNING: buffer_low_watermark (%d) is greater than buffer_high_watermark (%d) -- using buffer_high_watermark for both\n' %(self._options['buffer_low_watermark'], self._options['buffer_high_watermark']) )
+            self._options['buffer_low_watermark'] = self._options['buffer_high_watermark']
+
+        self._processBoolOption('instrument')
+        self._processIntOption('instrument_sample', 1)
+
+        self._processIntOption('spillover_connections', 0)
+        self._processIntOption('spillover_failure_rate', 0)
+        if self._options['spillover_failure_rate'] > 100:
+            logerr('WARNING: spillover_failure_rate is a percent, got %d -- using 100\n' %(self._options['spillover_failure_rate'],))
+            self._options['spillover_failure_rate'] = 100
+        self._processIntOption('spillover_retry_interval', 1)
+
+        self._processIntOption('udp_idle_timeout', 1)
+        self._processIntOption('udp_max_flows', 1)
+        if self.has_option('options', 'profile_dir'):
+            self._options['profile_dir'] = self.get('options', 'profile_dir').strip() or None
+
+    def _processBoolOption(self, optionName):
+        '''
+            _processBoolOption - Parse a 0/1/true/false option from [options]. Missing options retain their default.
+        '''
+        if not self.has_option('options', optionName):
+            return
+
+        value = self.get('options', optionName).strip()
+        if value == '1' or value.lower() == 'true':
+            self._options[optionName] = True
+        elif value == '0' or value.lower() == 'false':
+            self._options[optionName] = False
+        else:
+            logerr('WARNING: Unknown value for [options] -> %s "%s" -- ignoring value, retaining previous "%s"\n' %(optionName, value, str(self._options[optionName])) )
+
+    def _processIntOption(self, optionName, minValue):
+        '''
+            _processIntOption - Parse an integer option from [options] which must be >= minValue. Missing options retain their default.
+        '''
+        if not self.has_option('options', optionName):
+            return
+
+        value = self.get('options', optionName).strip()
+        if value.isdigit() and int(value) >= minValue:
+            self._options[optionName] = int(value)
+        else:
+            logerr('WARNING: %s must be an integer >= %d. Got "%s" -- ignoring value, retaining previous "%s"\n' %(optionName, minValue, value, str(self._options[optionName])) )
+
     def _processMappings(self):
 
         if 'mappings' not in self._sections:
@@ -129,13 +241,22 @@ class PumpkinConfig(ConfigParser):
         mappingSectionItems = self.items('mappings')
         
         for (addrPort, workers) in mappingSectionItems:
-            addrPortSplit = addrPort.split(':')
+            # An optional "tcp:" or "udp:" prefix gives the protocol
+            protocol = 'tcp'
+            localAddrPort = addrPort
+            for protocolName in ('tcp', 'udp'):
+                if addrPort.startswith(protocolName + ':'):
+                    protocol = protocolName
+                    localAddrPort = addrPort[len(protocolName) + 1:]
+                    break
+
+            addrPortSplit = localAddrPort.split(':')
             addrPortSplitLen = len(addrPortSplit)
             if not workers:
                 logerr('WARNING: Skipping, no workers defined for %s\n' %(addrPort,))
                 continue
             if addrPortSplitLen == 1:
-                (localAddr, localPort) = ('0.0.0.0', addrPort)
+                (localAddr, localPort) = ('0.0.0.0', localAddrPort)
             elif addrPortSplitLen == 2:
                 (localAddr, localPort) = addrPortSplit
             else:
@@ -147,33 +268,115 @@ class PumpkinConfig(ConfigParser):
                 logerr('WARNING: Skipping Invalid mapping, cannot convert port: %s\n' %(addrPort,))
                 continue
 
+            # Workers are split into tiers by "|", the first tier being the primaries and each following tier a backup for those before it
             workerLst = []
-            for worker in workers.split(','):
-                workerSplit = worker.split(':')
-                if len(workerSplit) != 2 or len(workerSplit[0]) < 3 or len(workerSplit[1]) == 0:
-                    logerr('WARNING: Skipping Invalid Worker %s\n' %(worker,))
+            for (tier, tierWorkers) in enumerate(workers.split('|')):
+                for worker in tierWorkers.split(','):
+                    workerSplit = worker.strip().split(':')
+                    if len(workerSplit) != 2 or len(workerSplit[0]) < 3 or len(workerSplit[1]) == 0:
+                        logerr('WARNING: Skipping Invalid Worker %s\n' %(worker,))
+                        continue
 
-                if preResolveWorkers is True:
                     try:
-                        addr = socket.gethostbyname(workerSplit[0])
-                    except:
-                        logerr('WARNING: Skipping Worker, could not resolve %s\n' %(workerSplit[0],))
-                else:
-                    addr = workerSplit[0]
-                try:
-                    port = int(workerSplit[1])
-                except ValueError:
-                    logerr('WARNING: Skipping worker, could not parse port %s\n' %(workerSplit[1],))
-
-                workerLst.append({'addr' : addr, 'port' : port})
+                        port = int(workerSplit[1])
+                    except ValueError:
+                        logerr('WARNING: Skipping worker, could not parse port %s\n' %(workerSplit[1],))
+                        continue
+
+                    workerLst.append({'addr' : workerSplit[0], 'port' : port, 'tier' : tier})
 
             keyName = "%s:%s" %(localAddr, addrPort)
             if keyName in mappings:
                 logerr('WARNING: Overriding existing mapping of %s with %s\n' %(addrPort, str(workerLst)))
-            mappings[addrPort] = PumpkinMapping(localAddr, localPort, workerLst)
+            mappings[addrPort] = PumpkinMapping(localAddr, localPort, workerLst, protocol)
+
+        if preResolveWorkers is True:
+            self._resolveWorkers(mappings)
+
+        for addrPort in list(mappings.keys()):
+            if not mappings[addrPort].workers:
+                logerr('WARNING: Skipping, no valid workers for %s\n' %(addrPort,))
+                del mappings[addrPort]
 
         self._mappings = mappings
 
+    def _resolveWorkers(self, mappings):
+        '''
+            _resolveWorkers - Resolve every worker hostname across all mappings in parallel (each distinct name once),
+              replacing them with their addresses. Workers which cannot be resolved within resolve_timeout are skipped.
+        '''
+        startTime = time.time()
+
+        hostnames = set()
+        for mapping in mappings.values():
+            for worker in mapping.workers:
+                hostnames.add(worker['addr'])
+
+        resolved = resolveHostnames(hostnames, self._options['resolve_timeout'])
+
+        for mapping in mappings.values():
+            resolvedWorkers = []
+            for worker in mapping.workers:
+                addr = resolved.get(worker['addr'], None)
+                if addr is None:
+                    logerr('WARNING: Skipping Worker, could not resolve %s\n' %(worker['addr'],))
+                    continue
+                resolvedWorkers.append({'addr' : addr, 'port' : worker['port'], 'tier' : worker['tier']})
+            mapping.workers = resolvedWorkers
+
+        self._timings['resolve'] = time.time() - startTime
+        self._timings['resolve_count'] = len(hostnames)
+
+
+    def _processTLS(self):
+        '''
+            _processTLS - Process the [tls:$mapping] sections, where $mapping is the key used in [mappings] (e.x. [tls:443])
+        '''
+        for sectionName in self.sections():
+            if not sectionName.startswith('tls:'):
+                continue
+
+            mappingKey = sectionName[4:]
+            if mappingKey not in self._mappings:
+                logerr('WARNING: Ignoring [%s], no mapping "%s" in [mappings]\n' %(sectionName, mappingKey))
+                continue
+
+            if self._mappings[mappingKey].protocol != 'tcp':
+                logerr('WARNING: Ignoring [%s], TLS is only supported on tcp mappings\n' %(sectionName,))
+                continue
+
+            if not isTLSAvailable():
+                raise PumpkinConfigException('ERROR: [%s] requires TLS, but this python has no "ssl" module.\n' %(sectionName,))
+
+            certfile = self._getSectionValue(sectionName, 'certfile')
+            keyfile = self._getSectionValue(sectionName, 'keyfile')
+            backendCAFile = self._getSectionValue(sectionName, 'backend_cafile')
+            for filename in (certfile, keyfile, backendCAFile):
+                if filename and not os.path.isfile(filename):
+                    raise PumpkinConfigException('ERROR: [%s] file does not exist: "%s"\n' %(sectionName, filename))
+
+            if keyfile and not certfile:
+                raise PumpkinConfigException('ERROR: [%s] has a keyfile but no certfile.\n' %(sectionName,))
+
+            backendTLS = self._getSectionValue(sectionName, 'backend_tls') or '0'
+            if backendTLS == '1' or backendTLS.lower() == 'true':
+                backendTLS = True
+            elif backendTLS == '0' or backendTLS.lower() == 'false':
+                backendTLS = False
+            else:
+                raise PumpkinConfigException('ERROR: [%s] -> backend_tls must be 0 or 1, got "%s"\n' %(sectionName, backendTLS))
+
+            if not certfile and not backendTLS:
+                logerr('WARNING: [%s] has neither a certfile nor backend_tls=1, so does nothing\n' %(sectionName,))
+                continue
+
+            self._mappings[mappingKey].tls = PumpkinTLSConfig(certfile, keyfile, backendTLS, backendCAFile)
+
+    def _getSectionValue(self, sectionName, optionName):
+        if not self.has_option(sectionName, optionName):
+            return None
+        return self.get(sectionName, optionName).strip() or None
+
 
 class PumpkinConfigException(Exception):
     pass
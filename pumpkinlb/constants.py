@@ -7,3 +7,52 @@
 GRACEFUL_SHUTDOWN_TIME = 6
 
 DEFAULT_BUFFER_SIZE = 4096
+
+# Number of shared token buckets used for per-client-IP rate limits (bounds memory; colliding IPs share a bucket)
+DEFAULT_CLIENT_RATE_SLOTS = 4096
+
+# Shortest time (seconds) a throttled connection sleeps before checking its rate limit buckets again
+THROTTLE_MIN_WAIT = .005
+
+# Per-connection backpressure: stop reading a side once its peer has this many bytes pending, resume at the low watermark
+DEFAULT_BUFFER_HIGH_WATERMARK = 65536
+DEFAULT_BUFFER_LOW_WATERMARK = 16384
+
+# Worker hostnames are pre-resolved in parallel with up to this many threads
+MAX_RESOLVER_THREADS = 32
+
+DEFAULT_RESOLVE_TIMEOUT = 10
+
+# Seconds the main process waits at startup for every listener to bind before reporting, and carrying on regardless
+STARTUP_READY_TIMEOUT = 15
+
+# Bind retries back off from the first delay, doubling up to the max (seconds)
+BIND_RETRY_FIRST_DELAY = .1
+BIND_RETRY_MAX_DELAY = 5
+
+# With the "instrument" option on, time 1 in this many connections
+DEFAULT_INSTRUMENT_SAMPLE = 10
+
+# Seconds allowed for a TLS handshake, with either the client or a backend
+TLS_HANDSHAKE_TIMEOUT = 10
+
+# UDP mappings: seconds a flow (client address -> backend) may be idle before it is expired, and the most flows tracked at once
+DEFAULT_UDP_IDLE_TIMEOUT = 60
+DEFAULT_UDP_MAX_FLOWS = 65536
+
+# UDP mappings read up to this many datagrams from a socket each time it is readable
+UDP_RECV_BATCH = 64
+
+UDP_MAX_DATAGRAM = 65535
+
+# Each UDP flow holds a file descriptor, so udp_max_flows is capped at the open file limit less this many (for the listening socket, logs, etc)
+UDP_FD_HEADROOM = 32
+
+# Backend tiers: a backend is "down" once this percent of its recent connections fail, and is tried again after the retry interval (seconds)
+DEFAULT_SPILLOVER_FAILURE_RATE = 50
+DEFAULT_SPILLOVER_RETRY_INTERVAL = 10
+
+# Failure rates are measured over recent attempts, each counting half as much after this many seconds,
+#  and only once a backend has had this many (recent) attempts
+SPILLOVER_FAILURE_HALF_LIFE = 2
+SPILLOVER_MIN_ATTEMPTS = 3
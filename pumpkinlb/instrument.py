@@ -0,0 +1,151 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import multiprocessing
+import time
+
+# Phases timed for each sampled connection:
+#   choose     - accept returned -> backend chosen (includes any connection rate limit waits)
+#   dispatch   - accept returned -> worker process started (listener side, mostly fork cost)
+#   fork       - backend chosen -> worker process running
+#   connect    - worker running -> connected to backend
+#   tls        - TLS handshake with the client, on mappings which terminate TLS
+#   first_byte - connected to backend -> first byte received from backend
+#   session    - connected to backend -> connection closed
+PHASES = ('choose', 'dispatch', 'fork', 'connect', 'tls', 'first_byte', 'session')
+
+COUNTERS = ('connections', 'sampled', 'select_wakeups')
+
+# Histogram buckets are powers of two in microseconds. Bucket N holds durations < 2^N us (the last bucket has no upper bound)
+NUM_BUCKETS = 32
+
+
+class PumpkinInstrumentation(object):
+    '''
+        Per-phase timing histograms for a listener and its workers, kept in shared memory.
+
+          Only 1 in "sampleRate" connections is timed. When instrumentation is disabled no instance exists,
+            and the probe points reduce to a check against None.
+    '''
+
+    def __init__(self, sampleRate=1):
+        self.sampleRate = max(int(sampleRate), 1)
+
+        self._histograms = multiprocessing.RawArray('q', len(PHASES) * NUM_BUCKETS)
+        self._counters = multiprocessing.RawArray('q', len(COUNTERS))
+        self._lock = multiprocessing.Lock()
+
+        self._sinceLastSample = 0 # Only touched by the listener's accept loop
+
+    def newProbe(self):
+        '''
+            newProbe - Called by the listener for each accepted connection.
+              Returns a PumpkinProbe if this connection is sampled, otherwise None.
+        '''
+        # "connections" and "sampled" are only ever written from the listener process, so need no lock
+        self._counters[0] += 1
+        self._sinceLastSample += 1
+        if self._sinceLastSample < self.sampleRate:
+            return None
+        self._sinceLastSample = 0
+        self._counters[1] += 1
+        return PumpkinProbe(self)
+
+    def record(self, phase, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), NUM_BUCKETS - 1)
+        with self._lock:
+            self._histograms[PHASES.index(phase) * NUM_BUCKETS + bucket] += 1
+
+    def addCount(self, counterName, amount):
+        with self._lock:
+            self._counters[COUNTERS.index(counterName)] += amount
+
+    def getHistograms(self):
+        '''
+            getHistograms - Returns a dict of phase -> list of NUM_BUCKETS counts
+
+              Like getCounters, reads without the lock. These are called from the SIGUSR1 handler, which may interrupt
+                the listener's main thread while it holds the lock in record().
+        '''
+        histograms = self._histograms
+        return dict( [ (phase, histograms[i * NUM_BUCKETS : (i + 1) * NUM_BUCKETS]) for (i, phase) in enumerate(PHASES) ] )
+
+    def getCounters(self):
+        return dict(zip(COUNTERS, self._counters[:]))
+
+    @staticmethod
+    def _percentileUpperBound(buckets, total, percentile):
+        # Upper bound (in seconds) of the bucket containing the given percentile
+        target = total * percentile
+        seen = 0
+        for (i, count) in enumerate(buckets):
+            seen += count
+            if seen >= target:
+                return (2 ** i) / 1000000.0
+        return (2 ** (NUM_BUCKETS - 1)) / 1000000.0
+
+    def formatReport(self):
+        '''
+            formatReport - Returns a multi-line string summarizing the counters and each phase's histogram
+        '''
+        counters = self.getCounters()
+        lines = ['  Instrumentation (1 in %d connections sampled): %s' %(self.sampleRate, ', '.join(['%s=%d' %(name, counters[name]) for name in COUNTERS])) ]
+        histograms = self.getHistograms()
+        for phase in PHASES:
+            buckets = histograms[phase]
+            total = sum(buckets)
+            if total == 0:
+                lines.append('    %-10s  no samples' %(phase,))
+                continue
+            lines.append('    %-10s  n=%-8d p50<%.6fs  p90<%.6fs  p99<%.6fs' %(phase, total,
+                self._percentileUpperBound(buckets, total, .5),
+                self._percentileUpperBound(buckets, total, .9),
+                self._percentileUpperBound(buckets, total, .99),
+            ))
+        return '\n'.join(lines)
+
+
+class PumpkinProbe(object):
+    '''
+        Timestamps for a single sampled connection. Created in the listener, and carried into the worker process.
+    '''
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.times = {}
+        self.selectWakeups = 0
+
+        self.mark('accept')
+
+    def mark(self, name):
+        self.times[name] = time.time()
+
+    def recordPhase(self, phase, startMark, endMark):
+        times = self.times
+        if startMark in times and endMark in times:
+            self.instrumentation.record(phase, times[endMark] - times[startMark])
+
+    def finishListener(self):
+        '''
+            finishListener - Record the listener-side phases, once the worker has been started
+        '''
+        self.mark('dispatched')
+        self.recordPhase('choose', 'accept', 'chosen')
+        self.recordPhase('dispatch', 'accept', 'dispatched')
+
+    def finishWorker(self):
+        '''
+            finishWorker - Record the worker-side phases, once the connection has closed
+        '''
+        self.mark('closed')
+        self.recordPhase('fork', 'chosen', 'started')
+        self.recordPhase('connect', 'started', 'connected')
+        self.recordPhase('tls', 'tls_start', 'tls_done')
+        self.recordPhase('first_byte', 'connected', 'first_byte')
+        self.recordPhase('session', 'connected', 'closed')
+        if self.selectWakeups:
+            self.instrumentation.addCount('select_wakeups', self.selectWakeups)
+
+# vim: set ts=4 sw=4 expandtab
@@ -3,18 +3,24 @@
 #
 # See: https://github.com/kata198/PumpkinLB
 
+import cProfile
 import multiprocessing
 import os
-import random
 import socket
 import sys
 import signal
+import tempfile
 import time
 import threading
 
 from .log import logmsg, logerr
 from .worker import PumpkinWorker
-from .constants import DEFAULT_BUFFER_SIZE
+from .ratelimit import PumpkinRateLimits, takeFromAll, waitTimeAll
+from .buffers import PumpkinBufferLimits
+from .instrument import PumpkinInstrumentation
+from .tls import PumpkinTLSStats
+from .tiers import PumpkinBackendTiers
+from .constants import DEFAULT_BUFFER_SIZE, BIND_RETRY_FIRST_DELAY, BIND_RETRY_MAX_DELAY, THROTTLE_MIN_WAIT
 
 
 class PumpkinListener(multiprocessing.Process):
@@ -23,12 +29,22 @@ class PumpkinListener(multiprocessing.Process):
     '''
 
 
-    def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE):
+    def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE, options=None, tlsConfig=None):
         multiprocessing.Process.__init__(self)
         self.localAddr = localAddr
         self.localPort = localPort
         self.workers = workers
         self.bufferSize = bufferSize
+        self.options = options or {}
+        self.tlsConfig = tlsConfig  # PumpkinTLSConfig, if this mapping uses TLS. Its contexts are created before we are started.
+
+        self.rateLimits = None    # PumpkinRateLimits, created in the listener process so workers share the buckets
+        self.bufferLimits = None  # PumpkinBufferLimits, likewise shared by all workers on this listener
+        self.instrumentation = None # PumpkinInstrumentation, if the "instrument" option is enabled
+        self.tlsStats = None      # PumpkinTLSStats, if tlsConfig is set
+        self.backendTiers = None  # PumpkinBackendTiers, chooses which worker gets each connection
+
+        self.profiler = None      # cProfile.Profile while profiling is toggled on with SIGUSR2
 
         self.activeWorkers = []   # Workers currently processing a job
 
@@ -38,6 +54,8 @@ class PumpkinListener(multiprocessing.Process):
 
         self.keepGoing = True     # Flips to False when the application is set to terminate
 
+        self.readyEvent = multiprocessing.Event() # Set once we are bound and listening
+
     def cleanup(self):
         time.sleep(2) # Wait for things to kick off
         while self.keepGoing is True:
@@ -48,7 +66,60 @@ class PumpkinListener(multiprocessing.Process):
                     self.activeWorkers.remove(worker)
             time.sleep(1.5)
 
+    def logBufferStats(self):
+        if self.bufferLimits is None:
+            return
+        stats = self.bufferLimits.getStats()
+        logmsg('Backpressure on %s:%d: %d watermark pauses, %d memory budget pauses, %d bytes buffered\n' %(self.localAddr, self.localPort, stats['watermark_pauses'], stats['budget_pauses'], stats['buffered_bytes']))
+
+    def dumpState(self, *args):
+        '''
+            dumpState - Log the live state of this listener: active workers, backpressure, and instrumentation if enabled.
+              Called on SIGUSR1.
+        '''
+        currentWorkers = self.activeWorkers[:]
+        lines = ['State of listener %s:%d (pid %d): %d active workers' %(self.localAddr, self.localPort, os.getpid(), len(currentWorkers))]
+        for worker in currentWorkers:
+            lines.append('  %s:%d -> %s:%d (pid %s)' %(worker.clientAddr[0], worker.clientAddr[1], worker.workerAddr, worker.workerPort, str(worker.pid)))
+        if self.bufferLimits is not None:
+            stats = self.bufferLimits.getStats()
+            lines.append('  Backpressure: %d watermark pauses, %d memory budget pauses, %d bytes buffered' %(stats['watermark_pauses'], stats['budget_pauses'], stats['buffered_bytes']))
+        if self.backendTiers is not None:
+            lines.append(self.backendTiers.formatState())
+        if self.tlsStats is not None:
+            stats = self.tlsStats.getStats()
+            lines.append('  TLS: %d handshakes (%.2f/s since the last dump, %.2f/s average since start), %d resumed, %d failed, %d backend handshakes' %(stats['handshakes'], stats['recent_handshakes_per_second'], stats['average_handshakes_per_second'], stats['resumed'], stats['failed'], stats['backend_handshakes']))
+        if self.instrumentation is not None:
+            lines.append(self.instrumentation.formatReport())
+        logmsg('\n'.join(lines) + '\n')
+
+    def toggleProfile(self, *args):
+        '''
+            toggleProfile - Called on SIGUSR2. The first signal starts profiling the accept loop with cProfile,
+              the next stops it and writes the stats to a file in the "profile_dir" option.
+        '''
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            logmsg('Started profiling listener %s:%d (pid %d). Send SIGUSR2 again to write the snapshot.\n' %(self.localAddr, self.localPort, os.getpid()))
+            return
+
+        profiler = self.profiler
+        self.profiler = None
+        profiler.disable()
+
+        profileDir = self.options.get('profile_dir', None) or tempfile.gettempdir()
+        filename = os.path.join(profileDir, 'pumpkinlb-%d-%d-%d.prof' %(self.localPort, os.getpid(), int(time.time())))
+        try:
+            profiler.dump_stats(filename)
+            logmsg('Wrote profile of listener %s:%d to %s\n' %(self.localAddr, self.localPort, filename))
+        except Exception as e:
+            logerr('Could not write profile to %s: %s\n' %(filename, str(e)))
+
     def closeWorkers(self, *args):
+        if self.keepGoing is True:
+            self.logBufferStats()
+
         self.keepGoing = False
 
         time.sleep(1)
@@ -100,8 +171,8 @@ class PumpkinListener(multiprocessing.Process):
             retryFailedWorkers - 
 
                 This function loops over current running workers and scans them for a multiprocess shared field called "failedToConnect".
-                  If this is set to 1, then we failed to connect to the backend worker. If that happens, we pick a different worker from the pool at random,
-                  and assign the client to that new worker.
+                  If this is set to 1, then we failed to connect to the backend worker. If that happens, we pick a different worker from the best available tier
+                  (see PumpkinBackendTiers), and assign the client to that new worker.
         '''
 
 
@@ -113,18 +184,12 @@ class PumpkinListener(multiprocessing.Process):
                 if worker.failedToConnect.value == 1:
                     successfulRuns = -1 # Reset the "roll" of successful runs so we start doing shorter sleeps
                     logmsg('Found a failure to connect to worker\n')
-                    numWorkers = len(self.workers)
-                    if numWorkers > 1:
-                        nextWorkerInfo = None
-                        while (nextWorkerInfo is None) or (worker.workerAddr == nextWorkerInfo['addr'] and worker.workerPort == nextWorkerInfo['port']):
-                            nextWorkerInfo = self.workers[random.randint(0, numWorkers-1)]
-                    else:
-                        # In this case, we have no option but to try on the same host.
-                        nextWorkerInfo = self.workers[0]
+                    # Picks another backend from the best available tier. If there is only one backend, we have no option but to try on the same host.
+                    nextWorkerInfo = self.backendTiers.chooseWorker(exclude=(worker.workerAddr, worker.workerPort))
 
                     logmsg('Retrying request from %s from %s:%d on %s:%d\n' %(worker.clientAddr, worker.workerAddr, worker.workerPort, nextWorkerInfo['addr'], nextWorkerInfo['port']))
 
-                    nextWorker = PumpkinWorker(worker.clientSocket, worker.clientAddr, nextWorkerInfo['addr'], nextWorkerInfo['port'], self.bufferSize)
+                    nextWorker = self._createWorker(worker.clientSocket, worker.clientAddr, nextWorkerInfo)
                     nextWorker.start()
                     self.activeWorkers.append(nextWorker)
                     worker.failedToConnect.value = 0 # Clean now
@@ -135,12 +200,48 @@ class PumpkinListener(multiprocessing.Process):
                 time.sleep(2)
             else:
                 time.sleep(.05)
-                    
-        
+
+
+    def _createWorker(self, clientConnection, clientAddr, workerInfo, probe=None):
+        byteBuckets = self.rateLimits.getByteBuckets(clientAddr[0], workerInfo['addr'], workerInfo['port'])
+        worker = PumpkinWorker(clientConnection, clientAddr, workerInfo['addr'], workerInfo['port'], self.bufferSize, byteBuckets, self.bufferLimits, probe, self.tlsConfig, self.tlsStats, self.backendTiers)
+        if worker.backendIdx is not None:
+            self.backendTiers.connectionStarted(worker.backendIdx)
+        return worker
+
+    def _waitForMappingConnection(self):
+        '''
+            _waitForMappingConnection - Block until the mapping is under its new connections/s limit.
+              Pending connections wait in the listen backlog meanwhile.
+        '''
+        buckets = self.rateLimits.getMappingConnectionBuckets()
+        while self.keepGoing is True and takeFromAll(buckets, 1) == 0:
+            time.sleep(waitTimeAll(buckets))
+
+    def _takeBackendConnectionToken(self, workerInfo):
+        return takeFromAll(self.rateLimits.getBackendConnectionBuckets(workerInfo['addr'], workerInfo['port']), 1) == 1
+
+    def _chooseBackend(self):
+        '''
+            _chooseBackend - Choose the backend for a new connection (see PumpkinBackendTiers.chooseWorker), skipping
+              backends which are at their new connections/s limit. If every backend is at its limit, waits for the first to free up.
+        '''
+        rateLimits = self.rateLimits
+        while self.keepGoing is True:
+            workerInfo = self.backendTiers.chooseWorker(canUse=self._takeBackendConnectionToken)
+            if workerInfo is not None:
+                return workerInfo
+            waitTime = min( [waitTimeAll(rateLimits.getBackendConnectionBuckets(candidate['addr'], candidate['port'])) for candidate in self.workers] )
+            time.sleep(max(waitTime, THROTTLE_MIN_WAIT))
+        return None
 
     def run(self):
         signal.signal(signal.SIGTERM, self.closeWorkers)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.dumpState)
+            signal.signal(signal.SIGUSR2, self.toggleProfile)
 
+        retryDelay = BIND_RETRY_FIRST_DELAY
         while True:
             try:
                 listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -156,11 +257,24 @@ class PumpkinListener(multiprocessing.Process):
                 self.listenSocket = listenSocket
                 break
             except Exception as e:
-                logerr('Failed to bind to %s:%d. "%s" Retrying in 5 seconds.\n' %(self.localAddr, self.localPort, str(e)))
-                time.sleep(5)
+                logerr('Failed to bind to %s:%d. "%s" Retrying in %.1f seconds.\n' %(self.localAddr, self.localPort, str(e), retryDelay))
+                time.sleep(retryDelay)
+                retryDelay = min(retryDelay * 2, BIND_RETRY_MAX_DELAY)
 
         listenSocket.listen(5)
 
+        self.rateLimits = PumpkinRateLimits(self.options, self.workers)
+        self.bufferLimits = PumpkinBufferLimits.fromOptions(self.options)
+        if self.options.get('instrument', False) is True:
+            self.instrumentation = instrumentation = PumpkinInstrumentation(self.options.get('instrument_sample', 1))
+        else:
+            instrumentation = None
+        if self.tlsConfig is not None:
+            self.tlsStats = PumpkinTLSStats()
+        self.backendTiers = PumpkinBackendTiers.fromOptions(self.workers, self.options)
+
+        self.readyEvent.set()
+
         # Create thread that will cleanup completed tasks
         self.cleanupThread = cleanupThread = threading.Thread(target=self.cleanup)
         cleanupThread.start()
@@ -171,23 +285,44 @@ class PumpkinListener(multiprocessing.Process):
 
         try:
             while self.keepGoing is True:
-                for workerInfo in self.workers:
-                    if self.keepGoing is False:
-                        break
+                if self.keepGoing is False:
+                    break
+                self._waitForMappingConnection()
+                try:
+                    (clientConnection, clientAddr) = listenSocket.accept()
+                except:
+                    logerr('Cannot bind to %s:%s\n' %(self.localAddr, self.localPort))
+                    if self.keepGoing is True:
+                        # Exception did not come from termination process, so keep rollin'
+                        time.sleep(3)
+                        continue
+                    
+                    raise # Termination DID come from termination process, so abort.
+
+                probe = instrumentation.newProbe() if instrumentation is not None else None
+
+                if takeFromAll(self.rateLimits.getClientConnectionBuckets(clientAddr[0]), 1) == 0:
+                    logerr('Rejecting connection from %s on %s:%d, over client connection rate limit\n' %(clientAddr[0], self.localAddr, self.localPort))
                     try:
-                        (clientConnection, clientAddr) = listenSocket.accept()
+                        clientConnection.close()
                     except:
-                        logerr('Cannot bind to %s:%s\n' %(self.localAddr, self.localPort))
-                        if self.keepGoing is True:
-                            # Exception did not come from termination process, so keep rollin'
-                            time.sleep(3)
-                            continue
-                        
-                        raise # Termination DID come from termination process, so abort.
-
-                    worker = PumpkinWorker(clientConnection, clientAddr, workerInfo['addr'], workerInfo['port'], self.bufferSize)
-                    self.activeWorkers.append(worker)
-                    worker.start()
+                        pass
+                    continue
+
+                workerInfo = self._chooseBackend()
+                if workerInfo is None: # Terminating
+                    clientConnection.close()
+                    break
+
+                if probe is not None:
+                    probe.mark('chosen')
+
+                worker = self._createWorker(clientConnection, clientAddr, workerInfo, probe)
+                worker.start()
+                self.activeWorkers.append(worker)
+
+                if probe is not None:
+                    probe.finishListener()
         except Exception as e:
             logerr('Got exception: %s, shutting down workers on %s:%d\n' %(str(e), self.localAddr, self.localPort))
             self.closeWorkers()
@@ -0,0 +1,185 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import multiprocessing
+import time
+import zlib
+
+from .constants import DEFAULT_CLIENT_RATE_SLOTS
+
+
+class TokenBucketTable(object):
+    '''
+        A fixed-size table of token buckets, stored in shared memory so that every worker process forked
+          from the listener draws from the same buckets.
+
+        Keys are hashed into one of "numSlots" slots, so memory use is bounded no matter how many distinct
+          keys (e.g. client IPs) are seen. Keys which collide simply share a bucket.
+    '''
+
+    def __init__(self, rate, burst=None, numSlots=1):
+        self.rate = float(rate)
+        self.burst = float(max(burst or rate, 1))
+        self.numSlots = int(numSlots)
+
+        # Each slot is [ tokens, lastRefillTime ]
+        self._state = multiprocessing.RawArray('d', [self.burst, 0.0] * self.numSlots)
+        self._lock = multiprocessing.Lock()
+
+    def getSlot(self, key):
+        if self.numSlots == 1:
+            return 0
+        # Use crc32 rather than hash() so the slot is stable regardless of hash randomization
+        return (zlib.crc32(str(key).encode('utf-8')) & 0xffffffff) % self.numSlots
+
+    def getBucket(self, key=None):
+        '''
+            getBucket - Get a handle to the bucket for the given key
+        '''
+        return TokenBucket(self, self.getSlot(key))
+
+    def _refill(self, slot, now):
+        # Must be called with lock held
+        idx = slot * 2
+        state = self._state
+        tokens = state[idx] + ( (now - state[idx + 1]) * self.rate )
+        if tokens > self.burst:
+            tokens = self.burst
+        state[idx] = tokens
+        state[idx + 1] = now
+        return tokens
+
+    def take(self, slot, maxAmount):
+        with self._lock:
+            tokens = self._refill(slot, time.time())
+            granted = min(int(tokens), maxAmount)
+            if granted > 0:
+                self._state[slot * 2] = tokens - granted
+            return granted
+
+    def giveBack(self, slot, amount):
+        with self._lock:
+            idx = slot * 2
+            self._state[idx] = min(self._state[idx] + amount, self.burst)
+
+    def waitTime(self, slot, amount=1):
+        with self._lock:
+            tokens = self._refill(slot, time.time())
+            if tokens >= amount:
+                return 0
+            return (amount - tokens) / self.rate
+
+
+class TokenBucket(object):
+    '''
+        A handle to a single bucket within a TokenBucketTable
+    '''
+
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
+        self.burst = table.burst
+
+    def take(self, maxAmount):
+        '''
+            take - Take up to "maxAmount" tokens. Returns the number actually taken, which may be 0.
+        '''
+        return self.table.take(self.slot, maxAmount)
+
+    def giveBack(self, amount):
+        self.table.giveBack(self.slot, amount)
+
+    def waitTime(self, amount=1):
+        '''
+            waitTime - Seconds until "amount" tokens will be available (0 if available now)
+        '''
+        return self.table.waitTime(self.slot, amount)
+
+
+def takeFromAll(buckets, maxAmount):
+    '''
+        takeFromAll - Take the same number of tokens from every bucket in "buckets", up to "maxAmount".
+          Returns the number taken, which is limited by whichever bucket has the fewest tokens.
+    '''
+    granted = maxAmount
+    taken = []
+    for bucket in buckets:
+        got = bucket.take(granted)
+        taken.append( (bucket, got) )
+        if got < granted:
+            granted = got
+        if granted == 0:
+            break
+
+    for (bucket, got) in taken:
+        if got > granted:
+            bucket.giveBack(got - granted)
+
+    return granted
+
+
+def waitTimeAll(buckets, amount=1):
+    '''
+        waitTimeAll - Seconds until every bucket in "buckets" has "amount" tokens
+    '''
+    if not buckets:
+        return 0
+    return max( [bucket.waitTime(amount) for bucket in buckets] )
+
+
+class PumpkinRateLimits(object):
+    '''
+        Holds the bytes/s and new connections/s limits for a single mapping, per client IP,
+          for the mapping as a whole, and per backend worker.
+
+        A rate of 0 means unlimited.
+    '''
+
+    def __init__(self, options, workers):
+        clientSlots = options.get('client_rate_slots', DEFAULT_CLIENT_RATE_SLOTS)
+
+        self.clientBytes = self._makeTable(options.get('client_rate_bytes', 0), clientSlots)
+        self.clientConnections = self._makeTable(options.get('client_rate_connections', 0), clientSlots)
+
+        self.mappingBytes = self._makeTable(options.get('mapping_rate_bytes', 0))
+        self.mappingConnections = self._makeTable(options.get('mapping_rate_connections', 0))
+
+        self.backendBytes = {}
+        self.backendConnections = {}
+        backendRateBytes = options.get('backend_rate_bytes', 0)
+        backendRateConnections = options.get('backend_rate_connections', 0)
+        for workerInfo in workers:
+            key = (workerInfo['addr'], workerInfo['port'])
+            if key in self.backendBytes:
+                continue
+            self.backendBytes[key] = self._makeTable(backendRateBytes)
+            self.backendConnections[key] = self._makeTable(backendRateConnections)
+
+    @staticmethod
+    def _makeTable(rate, numSlots=1):
+        if not rate:
+            return None
+        return TokenBucketTable(rate, rate, numSlots)
+
+    @staticmethod
+    def _collectBuckets(tables, clientAddr):
+        return [table.getBucket(clientAddr) for table in tables if table is not None]
+
+    def getByteBuckets(self, clientAddr, workerAddr, workerPort):
+        '''
+            getByteBuckets - Get the list of bytes/s buckets which apply to a connection
+        '''
+        return self._collectBuckets( [self.clientBytes, self.mappingBytes, self.backendBytes.get( (workerAddr, workerPort) )], clientAddr)
+
+    def getMappingConnectionBuckets(self):
+        return self._collectBuckets( [self.mappingConnections], None)
+
+    def getClientConnectionBuckets(self, clientAddr):
+        return self._collectBuckets( [self.clientConnections], clientAddr)
+
+    def getBackendConnectionBuckets(self, workerAddr, workerPort):
+        return self._collectBuckets( [self.backendConnections.get( (workerAddr, workerPort) )], None)
+
+# vim: set ts=4 sw=4 expandtab
@@ -0,0 +1,84 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import socket
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from .constants import MAX_RESOLVER_THREADS
+
+
+def isIPv4Address(hostname):
+    try:
+        socket.inet_aton(hostname)
+    except socket.error:
+        return False
+    return hostname.count('.') == 3
+
+
+def resolveHostnames(hostnames, timeout, maxThreads=MAX_RESOLVER_THREADS):
+    '''
+        resolveHostnames - Resolve a collection of hostnames in parallel. Each hostname is looked up only once,
+          and addresses which are already IPv4 are not looked up at all.
+
+          @param hostnames <iterable> - Hostnames to resolve
+          @param timeout <float> - Maximum seconds to wait for all lookups to complete
+
+          @return <dict> - hostname -> address. Hostnames which failed to resolve, or did not finish within "timeout", are omitted.
+    '''
+    results = {}
+    toResolve = Queue()
+    numToResolve = 0
+    for hostname in set(hostnames):
+        if isIPv4Address(hostname):
+            results[hostname] = hostname
+        else:
+            toResolve.put(hostname)
+            numToResolve += 1
+
+    if numToResolve == 0:
+        return results
+
+    resolved = {}
+    resolvedLock = threading.Lock()
+
+    def resolveWorker():
+        while True:
+            try:
+                hostname = toResolve.get_nowait()
+            except Empty:
+                return
+            try:
+                addr = socket.gethostbyname(hostname)
+            except Exception:
+                continue
+            with resolvedLock:
+                resolved[hostname] = addr
+
+    threads = []
+    for i in range(min(numToResolve, maxThreads)):
+        # Daemon, so a hung lookup can't keep us from exiting after we give up on it
+        thread = threading.Thread(target=resolveWorker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + timeout
+    for thread in threads:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        thread.join(remaining)
+
+    with resolvedLock:
+        results.update(resolved)
+    return results
+
+# vim: set ts=4 sw=4 expandtab
@@ -0,0 +1,196 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import multiprocessing
+import threading
+import time
+
+from .log import logmsg, logerr
+from .constants import DEFAULT_SPILLOVER_FAILURE_RATE, DEFAULT_SPILLOVER_RETRY_INTERVAL, SPILLOVER_MIN_ATTEMPTS, SPILLOVER_FAILURE_HALF_LIFE
+
+# Per-backend fields in PumpkinBackendTiers._state
+_ACTIVE = 0
+_ATTEMPTS = 1
+_FAILURES = 2
+_NUM_FIELDS = 3
+
+
+class PumpkinBackendTiers(object):
+    '''
+        Chooses backends for a mapping whose workers are split into tiers (e.x. a primary pool, and a backup pool in another DC).
+
+          Traffic goes round-robin to the lowest tier which has an available backend. A backend is unavailable while it is
+            "saturated" (has maxConnections active connections, if set) or "down" (at least maxFailureRate percent of recent
+            connection attempts failed). A down backend is tried again after retryInterval seconds, so traffic fails back
+            to the primaries automatically once they recover.
+
+          Active connection, attempt and failure counts are kept in shared memory, as they are updated by the worker processes.
+            The rest of the state belongs to the listener process, where both the accept loop and the retry thread choose backends,
+            so choosing is done under a (thread) lock.
+    '''
+
+    def __init__(self, workers, maxConnections=0, maxFailureRate=DEFAULT_SPILLOVER_FAILURE_RATE, retryInterval=DEFAULT_SPILLOVER_RETRY_INTERVAL):
+        self.workers = workers
+        self.maxConnections = maxConnections
+        self.maxFailureRate = maxFailureRate
+        self.retryInterval = retryInterval
+
+        self.indexes = {}  # (addr, port) -> index into self.workers and _state
+        tiers = {}
+        for (idx, workerInfo) in enumerate(workers):
+            self.indexes[ (workerInfo['addr'], workerInfo['port']) ] = idx
+            tiers.setdefault(workerInfo.get('tier', 0), []).append(idx)
+        self.tiers = [ tiers[tierNum] for tierNum in sorted(tiers.keys()) ]
+
+        self._state = multiprocessing.RawArray('q', len(workers) * _NUM_FIELDS)
+        self._lock = multiprocessing.Lock()
+
+        # Listener process only, guarded by _chooseLock
+        self._chooseLock = threading.Lock()
+        self._nextIdx = [0] * len(self.tiers)    # Round-robin position within each tier
+        self._downUntil = {}                     # index -> time it may be tried again
+        self._lastCounts = self._getCounts()     # (attempts, failures) for each backend as of the last _evaluate
+        self._recent = [ [0.0, 0.0] for workerInfo in workers ] # Decayed [attempts, failures] for each backend
+        self._lastEvaluated = time.time()
+        self._currentTier = 0
+
+    def _getCounts(self):
+        state = self._state
+        with self._lock:
+            return [ (state[idx * _NUM_FIELDS + _ATTEMPTS], state[idx * _NUM_FIELDS + _FAILURES]) for idx in range(len(self.workers)) ]
+
+    def _add(self, idx, field, amount):
+        with self._lock:
+            self._state[idx * _NUM_FIELDS + field] += amount
+
+    def getIndex(self, workerInfo):
+        return self.indexes.get( (workerInfo['addr'], workerInfo['port']), None)
+
+    def connectionStarted(self, idx):
+        with self._lock:
+            self._state[idx * _NUM_FIELDS + _ACTIVE] += 1
+            self._state[idx * _NUM_FIELDS + _ATTEMPTS] += 1
+
+    def connectionFinished(self, idx):
+        self._add(idx, _ACTIVE, -1)
+
+    def connectFailed(self, idx):
+        self._add(idx, _FAILURES, 1)
+
+    def _evaluate(self, now):
+        '''
+            _evaluate - Mark backends down whose recent failure rate is too high, and bring back those whose retry interval has passed
+        '''
+        elapsed = now - self._lastEvaluated
+        if elapsed < .1:
+            return
+        self._lastEvaluated = now
+
+        counts = self._getCounts()
+        decay = 0.5 ** (elapsed / SPILLOVER_FAILURE_HALF_LIFE)
+        for (idx, (attempts, failures)) in enumerate(counts):
+            (lastAttempts, lastFailures) = self._lastCounts[idx]
+            recent = self._recent[idx]
+            recent[0] = recent[0] * decay + (attempts - lastAttempts)
+            recent[1] = recent[1] * decay + (failures - lastFailures)
+
+            if self.maxFailureRate and idx not in self._downUntil and recent[0] >= SPILLOVER_MIN_ATTEMPTS and recent[1] * 100 >= self.maxFailureRate * recent[0]:
+                workerInfo = self.workers[idx]
+                logerr('Backend %s:%d is down (%d%% of recent connections failed), retrying in %d seconds\n' %(workerInfo['addr'], workerInfo['port'], int(recent[1] * 100 / recent[0]), self.retryInterval))
+                self._downUntil[idx] = now + self.retryInterval
+        self._lastCounts = counts
+
+        for (idx, downUntil) in list(self._downUntil.items()):
+            if now >= downUntil:
+                # Let it have traffic again, judged only on what happens from here. If it is still failing, it will be marked down again.
+                self._downUntil.pop(idx, None)
+                self._recent[idx] = [0.0, 0.0]
+
+    def isAvailable(self, idx):
+        if idx in self._downUntil:
+            return False
+        if self.maxConnections and self._state[idx * _NUM_FIELDS + _ACTIVE] >= self.maxConnections:
+            return False
+        return True
+
+    def chooseWorker(self, exclude=None, canUse=None):
+        '''
+            chooseWorker - Choose the backend for a new connection: round-robin within the lowest tier that has an available backend.
+              If no backend is available anywhere, falls back to round-robin over the primary tier.
+
+              @param exclude <None/tuple> - Optional (addr, port) to avoid, e.x. a backend which just failed
+              @param canUse <None/function> - Optional function(workerInfo) -> bool, e.x. taking from the backend's connection rate limit.
+                Only called on the backend about to be chosen. A backend it rejects is skipped, just like an unavailable one.
+
+              @return <dict/None> - The workerInfo, or None if "canUse" rejected every backend
+        '''
+        with self._chooseLock:
+            return self._chooseWorker(time.time(), exclude, canUse)
+
+    def _chooseWorker(self, now, exclude, canUse):
+        self._evaluate(now)
+
+        excludeIdx = self.indexes.get(exclude, None) if exclude is not None else None
+
+        for (tierNum, tier) in enumerate(self.tiers):
+            numInTier = len(tier)
+            for i in range(numInTier):
+                idx = tier[ (self._nextIdx[tierNum] + i) % numInTier ]
+                if idx != excludeIdx and self.isAvailable(idx) and (canUse is None or canUse(self.workers[idx])):
+                    if excludeIdx is None:
+                        # A retry avoiding one backend shouldn't shift the round-robin, or mean the whole tier is unavailable
+                        self._nextIdx[tierNum] = (self._nextIdx[tierNum] + i + 1) % numInTier
+                        self._setCurrentTier(tierNum)
+                    return self.workers[idx]
+
+        # Nothing is available, so the primaries are our best bet
+        candidates = [idx for idx in self.tiers[0] if idx != excludeIdx] or [idx for idx in range(len(self.workers)) if idx != excludeIdx] or [excludeIdx]
+        numCandidates = len(candidates)
+        for i in range(numCandidates):
+            idx = candidates[ (self._nextIdx[0] + i) % numCandidates ]
+            if canUse is None or canUse(self.workers[idx]):
+                self._nextIdx[0] = (self._nextIdx[0] + i + 1) % numCandidates
+                return self.workers[idx]
+        return None
+
+    def _setCurrentTier(self, tierNum):
+        if tierNum == self._currentTier:
+            return
+        if tierNum > self._currentTier:
+            logerr('Spilling over to backend tier %d\n' %(tierNum,))
+        else:
+            logmsg('Failing back to backend tier %d\n' %(tierNum,))
+        self._currentTier = tierNum
+
+    def formatState(self):
+        '''
+            formatState - Returns a multi-line string with each backend's tier, active connections, and whether it is down
+
+              This runs in the SIGUSR1 handler, possibly while the same thread holds _chooseLock, so it must not take that lock.
+        '''
+        now = time.time()
+        lines = ['  Backends (currently using tier %d):' %(self._currentTier,)]
+        state = self._state
+        for (tierNum, tier) in enumerate(self.tiers):
+            for idx in tier:
+                workerInfo = self.workers[idx]
+                base = idx * _NUM_FIELDS
+                status = 'up'
+                if idx in self._downUntil:
+                    status = 'down, retry in %ds' %(max(self._downUntil[idx] - now, 0),)
+                elif self.maxConnections and state[base + _ACTIVE] >= self.maxConnections:
+                    status = 'saturated'
+                lines.append('    tier %d  %s:%d  active=%d attempts=%d failures=%d  %s' %(tierNum, workerInfo['addr'], workerInfo['port'], state[base + _ACTIVE], state[base + _ATTEMPTS], state[base + _FAILURES], status))
+        return '\n'.join(lines)
+
+    @classmethod
+    def fromOptions(cls, workers, options):
+        return cls(workers,
+            options.get('spillover_connections', 0),
+            options.get('spillover_failure_rate', DEFAULT_SPILLOVER_FAILURE_RATE),
+            options.get('spillover_retry_interval', DEFAULT_SPILLOVER_RETRY_INTERVAL),
+        )
+
+# vim: set ts=4 sw=4 expandtab
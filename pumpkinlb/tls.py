@@ -0,0 +1,147 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import multiprocessing
+import time
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+# Indexes into PumpkinTLSStats._state
+_HANDSHAKES = 0
+_RESUMED = 1
+_FAILED = 2
+_BACKEND_HANDSHAKES = 3
+
+# Server contexts, keyed by (certfile, keyfile), so that mappings using the same certificate share one
+_serverContexts = {}
+
+
+def isTLSAvailable():
+    return ssl is not None
+
+
+def _newContext(protocolName):
+    protocol = getattr(ssl, protocolName, None)
+    if protocol is not None:
+        return ssl.SSLContext(protocol)
+
+    # Older pythons without PROTOCOL_TLS_SERVER / PROTOCOL_TLS_CLIENT
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    return context
+
+
+class PumpkinTLSConfig(object):
+    '''
+        TLS settings for a single mapping, from its [tls:...] config section.
+
+          certfile / keyfile - If set, TLS is terminated on the listening side using this certificate
+          backendTLS - If True, connections to the backend workers are made over TLS
+          backendCAFile - If set, backend certificates are verified against this CA bundle. Otherwise they are not verified.
+
+        Contexts must be created (getServerContext / getClientContext) in the main process, before the listeners are started.
+          Every listener and worker process then inherits the same context, and so the same session ticket keys, which lets
+          a client resume its session no matter which process handles its next connection.
+    '''
+
+    def __init__(self, certfile=None, keyfile=None, backendTLS=False, backendCAFile=None):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.backendTLS = backendTLS
+        self.backendCAFile = backendCAFile
+
+        self._clientContext = None
+
+    def getServerContext(self):
+        '''
+            getServerContext - Get the ssl.SSLContext used to terminate TLS, or None if this mapping doesn't terminate TLS
+        '''
+        if not self.certfile:
+            return None
+
+        key = (self.certfile, self.keyfile)
+        context = _serverContexts.get(key, None)
+        if context is None:
+            context = _newContext('PROTOCOL_TLS_SERVER')
+            context.load_cert_chain(self.certfile, self.keyfile)
+            _serverContexts[key] = context
+        return context
+
+    def getClientContext(self):
+        '''
+            getClientContext - Get the ssl.SSLContext used to connect to backends, or None if backends are plaintext
+        '''
+        if not self.backendTLS:
+            return None
+
+        if self._clientContext is None:
+            context = _newContext('PROTOCOL_TLS_CLIENT')
+            # Workers are usually pre-resolved to addresses, so there is no hostname to check against
+            context.check_hostname = False
+            if self.backendCAFile:
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(self.backendCAFile)
+            else:
+                context.verify_mode = ssl.CERT_NONE
+            self._clientContext = context
+        return self._clientContext
+
+    def __repr__(self):
+        return 'PumpkinTLSConfig(certfile=%s, keyfile=%s, backendTLS=%s, backendCAFile=%s)' %(repr(self.certfile), repr(self.keyfile), repr(self.backendTLS), repr(self.backendCAFile))
+
+
+class PumpkinTLSStats(object):
+    '''
+        Handshake counters for a single listener, in shared memory so every worker process adds to them
+    '''
+
+    def __init__(self):
+        self.startTime = time.time()
+        self._lastSample = (self.startTime, 0) # (time, handshakes) as of the previous getStats, in the calling process
+
+        self._state = multiprocessing.RawArray('q', 4)
+        self._lock = multiprocessing.Lock()
+
+    def _increment(self, idx):
+        with self._lock:
+            self._state[idx] += 1
+
+    def countHandshake(self, resumed):
+        with self._lock:
+            self._state[_HANDSHAKES] += 1
+            if resumed:
+                self._state[_RESUMED] += 1
+
+    def countFailure(self):
+        self._increment(_FAILED)
+
+    def countBackendHandshake(self):
+        self._increment(_BACKEND_HANDSHAKES)
+
+    def getStats(self):
+        '''
+            getStats - Returns a dict of the handshake counters, the average handshakes per second since the listener started,
+              and handshakes per second since the previous call to getStats (e.x. the previous SIGUSR1 dump)
+
+              Reads without the lock, as this is called from the SIGUSR1 handler (see PumpkinBufferLimits.getStats)
+        '''
+        state = self._state
+        stats = {
+            'handshakes'         : state[_HANDSHAKES],
+            'resumed'            : state[_RESUMED],
+            'failed'             : state[_FAILED],
+            'backend_handshakes' : state[_BACKEND_HANDSHAKES],
+        }
+        now = time.time()
+        (lastTime, lastHandshakes) = self._lastSample
+        self._lastSample = (now, stats['handshakes'])
+        stats['average_handshakes_per_second'] = stats['handshakes'] / max(now - self.startTime, .001)
+        stats['recent_handshakes_per_second'] = (stats['handshakes'] - lastHandshakes) / max(now - lastTime, .001)
+        return stats
+
+# vim: set ts=4 sw=4 expandtab
@@ -0,0 +1,393 @@
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .log import logmsg, logerr
+from .tiers import PumpkinBackendTiers
+from .constants import DEFAULT_UDP_IDLE_TIMEOUT, DEFAULT_UDP_MAX_FLOWS, UDP_RECV_BATCH, UDP_MAX_DATAGRAM, UDP_FD_HEADROOM, BIND_RETRY_FIRST_DELAY, BIND_RETRY_MAX_DELAY
+
+# errnos meaning a non-blocking socket operation could not proceed right now
+_WOULD_BLOCK_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class TimerWheel(object):
+    '''
+        A hashed timer wheel, with one slot per "tickSeconds".
+
+          Items are not moved when their deadline changes. Instead, when a slot comes due its items are handed back
+            to the caller, which either expires them or schedules them again for their new deadline.
+          Deadlines further out than the wheel covers land in the last slot, and are simply rescheduled when it comes due.
+    '''
+
+    def __init__(self, numSlots, tickSeconds=1.0):
+        self.numSlots = numSlots
+        self.tickSeconds = float(tickSeconds)
+        self.slots = [ [] for i in range(numSlots) ]
+        self.currentTick = int(time.time() / self.tickSeconds)
+
+    def schedule(self, item, deadline):
+        tick = int(deadline / self.tickSeconds)
+        tick = min(max(tick, self.currentTick + 1), self.currentTick + self.numSlots - 1)
+        self.slots[tick % self.numSlots].append(item)
+
+    def advance(self, now):
+        '''
+            advance - Move the wheel forward to "now", returning every item whose slot came due
+        '''
+        nowTick = int(now / self.tickSeconds)
+        due = []
+        if nowTick - self.currentTick >= self.numSlots:
+            # Fell behind by a whole turn, everything is due
+            for slot in self.slots:
+                due.extend(slot)
+            self.slots = [ [] for i in range(self.numSlots) ]
+        else:
+            while self.currentTick < nowTick:
+                idx = (self.currentTick + 1) % self.numSlots
+                due.extend(self.slots[idx])
+                self.slots[idx] = []
+                self.currentTick += 1
+        self.currentTick = nowTick
+        return due
+
+
+class PumpkinUDPFlow(object):
+    '''
+        A client address, the backend its datagrams are sent to, and the connected socket used to talk to that backend
+    '''
+
+    def __init__(self, clientAddr, workerInfo, backendIdx, upstreamSocket, now):
+        self.clientAddr = clientAddr
+        self.workerInfo = workerInfo
+        self.backendIdx = backendIdx  # Index into the listener's PumpkinBackendTiers
+        self.upstreamSocket = upstreamSocket
+        self.lastActive = now
+        self.closed = False
+
+
+class _SelectPoller(object):
+    '''
+        Minimal stand-in for select.poll on platforms without it (e.x. Windows)
+    '''
+
+    def __init__(self):
+        self.fds = set()
+
+    def register(self, fd, eventmask=None):
+        self.fds.add(fd)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+
+    def poll(self, timeoutMs):
+        (readable, _, _) = select.select(list(self.fds), [], [], timeoutMs / 1000.0)
+        return [ (fd, 1) for fd in readable ]
+
+
+class PumpkinUDPListener(multiprocessing.Process):
+    '''
+        Listens for datagrams on a local port and forwards them to workers.
+
+          Each client address is a "flow", assigned a backend (see PumpkinBackendTiers) and given its own socket connected to that backend,
+            so replies can be relayed back to the right client. Flows which are idle for "udp_idle_timeout" seconds are expired.
+
+          All flows for a mapping are handled by this one process.
+    '''
+
+    def __init__(self, localAddr, localPort, workers, options=None):
+        multiprocessing.Process.__init__(self)
+        self.localAddr = localAddr
+        self.localPort = localPort
+        self.workers = workers
+        self.options = options = options or {}
+
+        self.idleTimeout = options.get('udp_idle_timeout', DEFAULT_UDP_IDLE_TIMEOUT)
+        self.maxFlows = options.get('udp_max_flows', DEFAULT_UDP_MAX_FLOWS)
+
+        self.listenSocket = None
+
+        self.flows = {}         # client address -> PumpkinUDPFlow
+        self.flowsByFd = {}     # upstream socket fd -> PumpkinUDPFlow
+        self.poller = None
+        self.timerWheel = None
+
+        self.backendTiers = None  # PumpkinBackendTiers, created in run()
+
+        self.stats = {
+            'from_clients'  : 0,
+            'to_clients'    : 0,
+            'dropped'       : 0,
+            'flows_created' : 0,
+            'flows_expired' : 0,
+        }
+
+        self.keepGoing = True     # Flips to False when the application is set to terminate
+
+        self.readyEvent = multiprocessing.Event() # Set once we are bound and listening
+
+    def _capMaxFlows(self):
+        '''
+            _capMaxFlows - Each flow holds a file descriptor, so make sure udp_max_flows fits under the open file limit
+        '''
+        if resource is None:
+            return
+        try:
+            (softLimit, hardLimit) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        except Exception:
+            return
+        if softLimit == resource.RLIM_INFINITY:
+            return
+        fdLimit = max(softLimit - UDP_FD_HEADROOM, 1)
+        if self.maxFlows > fdLimit:
+            logerr('WARNING: udp_max_flows=%d is more than the open file limit allows (%d), using %d for udp %s:%d. Raise the limit (e.x. ulimit -n) for more flows.\n' %(self.maxFlows, softLimit, fdLimit, self.localAddr, self.localPort))
+            self.maxFlows = fdLimit
+
+    def _newFlow(self, clientAddr, now):
+        '''
+            _newFlow - Create a flow for a client we have not seen (or whose flow expired).
+              Returns None if we are at udp_max_flows, or could not set up the flow's socket.
+        '''
+        if len(self.flows) >= self.maxFlows:
+            return None
+
+        backendTiers = self.backendTiers
+        workerInfo = backendTiers.chooseWorker()
+        backendIdx = backendTiers.getIndex(workerInfo)
+
+        try:
+            upstreamSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        except Exception as e:
+            # e.x. EMFILE. Not the backend's fault, so not counted against it.
+            logerr('Could not create socket for udp flow from %s:%d: %s\n' %(clientAddr[0], clientAddr[1], str(e)))
+            return None
+
+        backendTiers.connectionStarted(backendIdx)
+        try:
+            upstreamSocket.connect( (workerInfo['addr'], workerInfo['port']) )
+            upstreamSocket.setblocking(0)
+        except Exception as e:
+            logerr('Could not connect to worker %s:%d: %s\n' %(workerInfo['addr'], workerInfo['port'], str(e)))
+            upstreamSocket.close()
+            backendTiers.connectFailed(backendIdx)
+            backendTiers.connectionFinished(backendIdx)
+            return None
+
+        flow = PumpkinUDPFlow(clientAddr, workerInfo, backendIdx, upstreamSocket, now)
+        fd = upstreamSocket.fileno()
+        self.flows[clientAddr] = flow
+        self.flowsByFd[fd] = flow
+        self.poller.register(fd, select.POLLIN if hasattr(select, 'POLLIN') else None)
+        self.timerWheel.schedule(flow, now + self.idleTimeout)
+        self.stats['flows_created'] += 1
+        return flow
+
+    def _closeFlow(self, flow):
+        if flow.closed:
+            return
+        flow.closed = True
+        self.backendTiers.connectionFinished(flow.backendIdx)
+        fd = flow.upstreamSocket.fileno()
+        try:
+            self.poller.unregister(fd)
+        except Exception:
+            pass
+        self.flowsByFd.pop(fd, None)
+        if self.flows.get(flow.clientAddr, None) is flow:
+            del self.flows[flow.clientAddr]
+        try:
+            flow.upstreamSocket.close()
+        except:
+            pass
+
+    def _readFromClients(self, now):
+        '''
+            _readFromClients - Drain up to UDP_RECV_BATCH datagrams from the listening socket, forwarding each to its flow's backend
+        '''
+        listenSocket = self.listenSocket
+        flows = self.flows
+        received = dropped = 0
+        try:
+            for i in range(UDP_RECV_BATCH):
+                try:
+                    (data, clientAddr) = listenSocket.recvfrom(UDP_MAX_DATAGRAM)
+                except socket.error as e:
+                    if e.args and e.args[0] in _WOULD_BLOCK_ERRNOS:
+                        return
+                    raise
+                received += 1
+
+                flow = flows.get(clientAddr, None)
+                if flow is None:
+                    flow = self._newFlow(clientAddr, now)
+                    if flow is None:
+                        dropped += 1
+                        continue
+                flow.lastActive = now
+
+                try:
+                    flow.upstreamSocket.send(data)
+                except socket.error as e:
+                    # Drop the datagram, the client will retry
+                    dropped += 1
+                    if e.args and e.args[0] == errno.ECONNREFUSED:
+                        # The backend is not listening (ICMP port unreachable). The client's next datagram gets a new flow.
+                        self.backendTiers.connectFailed(flow.backendIdx)
+                        self._closeFlow(flow)
+                    # Otherwise (e.x. EAGAIN/ENOBUFS, the send buffer is full) keep the flow, so replies already on their way still reach the client
+        finally:
+            self.stats['from_clients'] += received
+            self.stats['dropped'] += dropped
+
+    def _readFromWorker(self, flow, now):
+        '''
+            _readFromWorker - Drain up to UDP_RECV_BATCH replies from a flow's backend, relaying each back to the client
+        '''
+        listenSocket = self.listenSocket
+        upstreamSocket = flow.upstreamSocket
+        clientAddr = flow.clientAddr
+        sent = dropped = 0
+        try:
+            for i in range(UDP_RECV_BATCH):
+                try:
+                    data = upstreamSocket.recv(UDP_MAX_DATAGRAM)
+                except socket.error as e:
+                    if e.args and e.args[0] in _WOULD_BLOCK_ERRNOS:
+                        break
+                    # e.x. ECONNREFUSED, the backend is not listening. The client's next datagram gets a new flow (and the next backend).
+                    logerr('Error reading from worker %s:%d for %s:%d: %s\n' %(flow.workerInfo['addr'], flow.workerInfo['port'], clientAddr[0], clientAddr[1], str(e)))
+                    if e.args and e.args[0] == errno.ECONNREFUSED:
+                        self.backendTiers.connectFailed(flow.backendIdx)
+                    self._closeFlow(flow)
+                    return
+                try:
+                    listenSocket.sendto(data, clientAddr)
+                    sent += 1
+                except socket.error:
+                    dropped += 1
+            flow.lastActive = now
+        finally:
+            self.stats['to_clients'] += sent
+            self.stats['dropped'] += dropped
+
+    def _expireFlows(self, now):
+        idleTimeout = self.idleTimeout
+        for flow in self.timerWheel.advance(now):
+            if flow.closed:
+                continue
+            deadline = flow.lastActive + idleTimeout
+            if deadline <= now:
+                self._closeFlow(flow)
+                self.stats['flows_expired'] += 1
+            else:
+                self.timerWheel.schedule(flow, deadline)
+
+    def dumpState(self, *args):
+        '''
+            dumpState - Log the live state of this listener. Called on SIGUSR1.
+        '''
+        stats = self.stats
+        msg = 'State of UDP listener %s:%d (pid %d): %d active flows\n  Datagrams: %d from clients, %d to clients, %d dropped. Flows: %d created, %d expired\n' %(
+            self.localAddr, self.localPort, os.getpid(), len(self.flows),
+            stats['from_clients'], stats['to_clients'], stats['dropped'], stats['flows_created'], stats['flows_expired'])
+        if self.backendTiers is not None:
+            msg += self.backendTiers.formatState() + '\n'
+        logmsg(msg)
+
+    def closeWorkers(self, *args):
+        self.keepGoing = False
+
+    def _shutdown(self):
+        for flow in list(self.flows.values()):
+            self._closeFlow(flow)
+        try:
+            self.listenSocket.close()
+        except:
+            pass
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sys.exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.closeWorkers)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.dumpState)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+        retryDelay = BIND_RETRY_FIRST_DELAY
+        while True:
+            try:
+                # No SO_REUSEADDR: UDP has no TIME_WAIT to get past, and on Linux it would let a second instance bind
+                #  the same port and silently split the datagrams with us
+                listenSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                listenSocket.bind( (self.localAddr, self.localPort) )
+                self.listenSocket = listenSocket
+                break
+            except Exception as e:
+                logerr('Failed to bind to udp %s:%d. "%s" Retrying in %.1f seconds.\n' %(self.localAddr, self.localPort, str(e), retryDelay))
+                time.sleep(retryDelay)
+                retryDelay = min(retryDelay * 2, BIND_RETRY_MAX_DELAY)
+
+        listenSocket.setblocking(0)
+        listenFd = listenSocket.fileno()
+
+        if hasattr(select, 'poll'):
+            self.poller = poller = select.poll()
+            poller.register(listenFd, select.POLLIN)
+        else:
+            self.poller = poller = _SelectPoller()
+            poller.register(listenFd)
+
+        self.backendTiers = PumpkinBackendTiers.fromOptions(self.workers, self.options)
+
+        self._capMaxFlows()
+
+        # One slot per second, enough to cover the idle timeout
+        self.timerWheel = TimerWheel(self.idleTimeout + 2)
+
+        self.readyEvent.set()
+
+        flowsByFd = self.flowsByFd
+        nextExpireTime = time.time() + 1
+        while self.keepGoing is True:
+            try:
+                events = poller.poll(1000)
+            except (select.error, IOError, OSError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                logerr('Got exception: %s, shutting down udp %s:%d\n' %(str(e), self.localAddr, self.localPort))
+                break
+
+            now = time.time()
+            try:
+                for (fd, event) in events:
+                    if fd == listenFd:
+                        self._readFromClients(now)
+                    else:
+                        flow = flowsByFd.get(fd, None)
+                        if flow is not None:
+                            self._readFromWorker(flow, now)
+            except Exception as e:
+                logerr('Error on udp %s:%d: %s\n' %(self.localAddr, self.localPort, str(e)))
+
+            if now >= nextExpireTime:
+                self._expireFlows(now)
+                nextExpireTime = now + 1
+
+        self.dumpState()
+        self._shutdown()
+
+# vim: set ts=4 sw=4 expandtab
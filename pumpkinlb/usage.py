@@ -8,7 +8,7 @@ import sys
 
 from . import __version__ as pumpkinlb_version
 
-from .constants import DEFAULT_BUFFER_SIZE
+from .constants import DEFAULT_BUFFER_SIZE, DEFAULT_CLIENT_RATE_SLOTS, DEFAULT_BUFFER_HIGH_WATERMARK, DEFAULT_BUFFER_LOW_WATERMARK, DEFAULT_RESOLVE_TIMEOUT, DEFAULT_INSTRUMENT_SAMPLE, DEFAULT_UDP_IDLE_TIMEOUT, DEFAULT_UDP_MAX_FLOWS, DEFAULT_SPILLOVER_FAILURE_RATE, DEFAULT_SPILLOVER_RETRY_INTERVAL
 
 def printUsage(toStream=sys.stdout):
     toStream.write('''Usage: %s [config file]
@@ -23,11 +23,15 @@ Starts Pumpkin Load Balancer using the given config file.
   Signals:
 
     SIGTERM                        Performs a graceful shutdown
+    SIGUSR1                        Log the live state of every listener (active connections, backpressure, and timing
+                                     histograms if the "instrument" option is on). May also be sent to a single listener process.
+    SIGUSR2                        Send to a listener process to start profiling it with cProfile, and again to write
+                                     the snapshot to "profile_dir". Listener pids are shown in the SIGUSR1 output.
+                                     Sent to the main process, it is passed on to every TCP listener.
 
 %s
 ''' %(os.path.basename(sys.argv[0]), getVersionStr())
     )
-#    SIGUSR1                        Re-read the config, and alter service to match TODO: NOT DONE
 
 
 
@@ -42,15 +46,66 @@ Config file is broken up into sections, definable by [$SectionName], followed by
       pre_resolve_workers=0/1                     [Default 1]    Any workers defined with a hostname will be evaluated at the time the config is read. 
                                                                    This is preferable as it saves a DNS trip for every request, and should be enabled
                                                                    unless your DNS is likely to change and you want the workers to match the change.
+                                                                   Hostnames are resolved in parallel, each distinct name only once.
+
+      resolve_timeout=N                           [Default %d]   Maximum seconds to spend pre-resolving worker hostnames. Workers not resolved in time are skipped.
 
       buffer_size=N                             [Default %d]   Default read/write buffer size (in bytes) used on socket operations. 4096 is a good default for most, but you may be able to tune better depending on your application.
 
+      client_rate_bytes=N                       [Default 0]      Limit each client IP to N bytes/s (both directions, across all its connections). 0 is unlimited.
+      client_rate_connections=N                 [Default 0]      Limit each client IP to N new connections/s. Connections over the limit are closed. 0 is unlimited.
+      client_rate_slots=N                       [Default %d]   Number of shared buckets used for per-client-IP limits. This bounds memory use; IPs which hash to the same slot share a limit.
+      mapping_rate_bytes=N                      [Default 0]      Limit each mapping to N bytes/s in total. 0 is unlimited.
+      mapping_rate_connections=N                [Default 0]      Limit each mapping to N new connections/s. Further connections wait in the listen backlog. 0 is unlimited.
+      backend_rate_bytes=N                      [Default 0]      Limit each backend worker to N bytes/s. 0 is unlimited.
+      backend_rate_connections=N                [Default 0]      Limit each backend worker to N new connections/s. Connections go to the next backend under its limit. 0 is unlimited.
+
+                                                                 Rate limits are enforced with token buckets in the relay loop. A throttled connection stops being read
+                                                                   (data stays in the kernel socket buffers) until tokens are available, so it uses no extra memory.
+
+      buffer_high_watermark=N                   [Default %d]  Per connection, stop reading from one side once N bytes are pending to be written to the other side.
+      buffer_low_watermark=N                    [Default %d]  Resume reading once the pending data has drained to N bytes.
+      buffer_memory_budget=N                    [Default 0]      Total bytes which may be buffered across all connections on a listener. Reads pause while it is used up. 0 is unlimited.
+
+                                                                 How often each kind of backpressure kicks in is logged when a listener shuts down.
+
+      instrument=0/1                            [Default 0]      Time the phases of sampled connections (backend choice, fork, connect, first byte, session) into
+                                                                   histograms, shown on SIGUSR1. When off, this adds no overhead.
+      instrument_sample=N                       [Default %d]     With instrument=1, time 1 in every N connections.
+      spillover_connections=N                   [Default 0]      Most active connections per worker before new connections spill over to the next tier. 0 is unlimited.
+      spillover_failure_rate=N                  [Default %d]     Percent of a worker's recent connection attempts which must fail for it to be marked down. 0 disables this.
+                                                                   Applies to every mapping, including ones without tiers: a down worker gets no new connections
+                                                                   until spillover_retry_interval passes, unless every worker is unavailable.
+      spillover_retry_interval=N                [Default %d]     Seconds before a down worker is tried again. Traffic fails back to lower tiers once they recover.
+      udp_idle_timeout=N                        [Default %d]     Seconds a UDP flow may be idle before it is expired.
+      udp_max_flows=N                           [Default %d]  Most UDP flows tracked per mapping. Datagrams from new clients are dropped while at the limit. Each flow uses a file descriptor, so this is capped at the open file limit (ulimit -n) less a few.
+      profile_dir=path                          [Default TMPDIR] Directory where SIGUSR2 profiling snapshots are written (defaults to the system temp dir).
+
     [mappings]
       localaddr:inport=worker1:port,worker2:port...              Listen on interface defined by "localaddr" on port "inport". Farm out to worker addresses and ports. Ex: 192.168.1.100:80=10.10.0.1:5900,10.10.0.2:5900
         or
       inport=worker1:port,worker2:port...                        Listen on all interfaces on port "inport", and farm out to worker addresses with given ports. Ex: 80=10.10.0.1:5900,10.10.0.2:5900
-
-''' %(DEFAULT_BUFFER_SIZE, )
+        or
+      udp:[localaddr:]inport=worker1:port,...                    Balance UDP datagrams instead of TCP connections. Ex: udp:53=10.10.0.1:53,10.10.0.2:53
+                                                                   Each client address is a flow, assigned a worker like a connection would be. Replies are relayed back to the client.
+                                                                   A "tcp:" prefix may also be given, and is the default.
+
+      Workers may be split into tiers with "|", e.x. 80=10.10.0.1:80,10.10.0.2:80|192.168.5.1:80
+                                                                 Connections go round-robin to the first tier, and only spill over to the next tier
+                                                                   while every worker before it is down or saturated (see the spillover_* options).
+
+    [tls:inport]                                                 Optional TLS for the mapping with key "inport" in [mappings], e.x. [tls:443]
+      certfile=path                                              Certificate (PEM) to terminate TLS with. Without this the listening side stays plaintext.
+      keyfile=path                                               Private key (PEM), if not contained in certfile
+      backend_tls=0/1                           [Default 0]      Connect to the workers over TLS
+      backend_cafile=path                                        Verify worker certificates against this CA bundle. Without this, worker certificates are not verified.
+
+                                                                 Handshakes are done in each connection's worker process, so they never block accepting connections.
+                                                                   All processes share the same session ticket keys, so clients can resume their TLS sessions
+                                                                   with session tickets. There is no shared session ID cache, so clients without ticket support
+                                                                   always do a full handshake. Handshake counts and rates are shown on SIGUSR1.
+
+''' %(DEFAULT_RESOLVE_TIMEOUT, DEFAULT_BUFFER_SIZE, DEFAULT_CLIENT_RATE_SLOTS, DEFAULT_BUFFER_HIGH_WATERMARK, DEFAULT_BUFFER_LOW_WATERMARK, DEFAULT_INSTRUMENT_SAMPLE, DEFAULT_SPILLOVER_FAILURE_RATE, DEFAULT_SPILLOVER_RETRY_INTERVAL, DEFAULT_UDP_IDLE_TIMEOUT, DEFAULT_UDP_MAX_FLOWS)
     )
 
 
@@ -3,6 +3,7 @@
 #
 # See: https://github.com/kata198/PumpkinLB
 
+import errno
 import multiprocessing
 import select
 import signal
@@ -10,15 +11,68 @@ import socket
 import sys
 import time
 
-from .constants import GRACEFUL_SHUTDOWN_TIME, DEFAULT_BUFFER_SIZE
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from .constants import GRACEFUL_SHUTDOWN_TIME, DEFAULT_BUFFER_SIZE, TLS_HANDSHAKE_TIMEOUT, THROTTLE_MIN_WAIT
 from .log import logmsg, logerr
+from .ratelimit import takeFromAll, waitTimeAll
+from .buffers import PumpkinBufferLimits
+
+# errnos meaning a non-blocking socket operation could not proceed right now
+_WOULD_BLOCK_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Likewise for TLS sockets, which may need to read or write (e.x. during renegotiation) before they can proceed
+if ssl is not None:
+    _SSL_WOULD_BLOCK_ERRORS = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+else:
+    _SSL_WOULD_BLOCK_ERRORS = ()
+
+
+def _nonBlockingRecv(sock, size):
+    '''
+        _nonBlockingRecv - recv on a non-blocking socket. Returns None if no data was actually available, b'' at EOF.
+    '''
+    try:
+        return sock.recv(size)
+    except _SSL_WOULD_BLOCK_ERRORS:
+        return None
+    except socket.error as e:
+        if e.args and e.args[0] in _WOULD_BLOCK_ERRNOS:
+            return None
+        raise
+
+
+def _nonBlockingSend(sock, data, chunkSize):
+    '''
+        _nonBlockingSend - Send as much of bytearray "data" as the socket will take without blocking,
+          removing what was sent from "data". Returns the number of bytes sent.
+    '''
+    totalSent = 0
+    while data:
+        try:
+            sent = sock.send(data[:chunkSize])
+        except _SSL_WOULD_BLOCK_ERRORS:
+            break
+        except socket.error as e:
+            if e.args and e.args[0] in _WOULD_BLOCK_ERRNOS:
+                break
+            raise
+        if not sent:
+            break
+        del data[:sent]
+        totalSent += sent
+    return totalSent
+
 
 class PumpkinWorker(multiprocessing.Process):
     '''
         A class which handles the worker-side of processing a request (communicating between the back-end worker and the requesting client)
     '''
 
-    def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE):
+    def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE, byteBuckets=None, bufferLimits=None, probe=None, tlsConfig=None, tlsStats=None, backendTiers=None):
         multiprocessing.Process.__init__(self)
 
         self.clientSocket = clientSocket
@@ -31,6 +85,23 @@ class PumpkinWorker(multiprocessing.Process):
 
         self.bufferSize = bufferSize
 
+        # Token buckets (see ratelimit.py) which every byte relayed in either direction must draw from.
+        #  When they run dry we stop reading until they refill, rather than buffering.
+        self.byteBuckets = byteBuckets or []
+
+        # Watermarks and the listener-wide memory budget (see buffers.py)
+        self.bufferLimits = bufferLimits or PumpkinBufferLimits()
+
+        # PumpkinProbe (see instrument.py) if this connection is sampled for timing, otherwise None
+        self.probe = probe
+
+        # PumpkinTLSConfig and PumpkinTLSStats (see tls.py), if this mapping uses TLS
+        self.tlsConfig = tlsConfig
+        self.tlsStats = tlsStats
+
+        # PumpkinBackendTiers (see tiers.py), which tracks active connections and failures for each backend
+        self.backendTiers = backendTiers
+        self.backendIdx = backendTiers.getIndex( {'addr' : workerAddr, 'port' : workerPort} ) if backendTiers is not None else None
 
         self.failedToConnect = multiprocessing.Value('i', 0)
 
@@ -53,70 +124,245 @@ class PumpkinWorker(multiprocessing.Process):
             pass
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
+    def _startBackendTLS(self, workerSocket):
+        '''
+            _startBackendTLS - Wrap the connected backend socket in TLS. Raises on failure.
+        '''
+        workerSocket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        workerSocket = self.tlsConfig.getClientContext().wrap_socket(workerSocket)
+        if self.tlsStats is not None:
+            self.tlsStats.countBackendHandshake()
+        return workerSocket
+
+    def _startClientTLS(self, clientSocket):
+        '''
+            _startClientTLS - Perform the server side of the TLS handshake with the client.
+
+                @return - The wrapped socket, or None if the handshake failed.
+        '''
+        probe = self.probe
+        if probe is not None:
+            probe.mark('tls_start')
+        try:
+            clientSocket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+            clientSocket = self.clientSocket = self.tlsConfig.getServerContext().wrap_socket(clientSocket, server_side=True)
+        except Exception as e:
+            logerr('TLS handshake failed with %s: %s\n' %(self.clientAddr[0], str(e)))
+            if self.tlsStats is not None:
+                self.tlsStats.countFailure()
+            return None
+
+        if probe is not None:
+            probe.mark('tls_done')
+        if self.tlsStats is not None:
+            self.tlsStats.countHandshake(clientSocket.session_reused)
+        return clientSocket
+
     def closeConnectionsAndExit(self, *args):
         self.closeConnections()
         sys.exit(0)
 
+    def _releaseBackend(self):
+        '''
+            _releaseBackend - No longer count this connection as active against its backend (see PumpkinBackendTiers)
+        '''
+        if self.backendIdx is not None:
+            self.backendTiers.connectionFinished(self.backendIdx)
+            self.backendIdx = None
+
     def run(self):
+        try:
+            self._run()
+        finally:
+            self._releaseBackend()
+
+    def _run(self):
+        probe = self.probe
+        if probe is not None:
+            probe.mark('started')
+
+        # SIGUSR1/SIGUSR2 are for the listener (see PumpkinListener.dumpState), don't run its handlers here
+        for signalName in ('SIGUSR1', 'SIGUSR2'):
+            if hasattr(signal, signalName):
+                signal.signal(getattr(signal, signalName), signal.SIG_IGN)
+        # Nor its SIGTERM handler, until we have connections of our own to close (e.x. while failing to connect, before a retry)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
         workerSocket = self.workerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientSocket = self.clientSocket
 
         bufferSize = self.bufferSize
+        byteBuckets = self.byteBuckets
 
         try:
             workerSocket.connect( (self.workerAddr, self.workerPort) )
+            if probe is not None:
+                probe.mark('connected')
+            if self.tlsConfig is not None and self.tlsConfig.backendTLS:
+                workerSocket = self.workerSocket = self._startBackendTLS(workerSocket)
         except:
             logerr('Could not connect to worker %s:%d\n' %(self.workerAddr, self.workerPort))
+            if self.backendIdx is not None:
+                self.backendTiers.connectFailed(self.backendIdx)
+                self._releaseBackend()
             self.failedToConnect.value = 1
             time.sleep(GRACEFUL_SHUTDOWN_TIME) # Give a few seconds for the "fail" reader to pick this guy up before we are removed by the joining thread
             return
 
         signal.signal(signal.SIGTERM, self.closeConnectionsAndExit)
 
+        # The client handshake happens only once we know the backend is up, because a failed backend is retried
+        #  by the listener using the (still plaintext) client socket.
+        if self.tlsConfig is not None and self.tlsConfig.certfile:
+            clientSocket = self._startClientTLS(clientSocket)
+            if clientSocket is None:
+                self.closeConnectionsAndExit()
+
+        # Data already decrypted and buffered inside a TLS socket doesn't show up in select
+        tlsSockets = [sock for sock in (clientSocket, workerSocket) if ssl is not None and isinstance(sock, ssl.SSLSocket)]
+
+        bufferLimits = self.bufferLimits
+        highWatermark = bufferLimits.highWatermark
+        lowWatermark = bufferLimits.lowWatermark
+
+        # While throttled, wait until a whole chunk can be read, rather than waking up (and sending a tiny segment) for every token
+        throttleChunk = int(min([bufferSize] + [bucket.burst for bucket in byteBuckets])) if byteBuckets else bufferSize
+
+        dataToClient = bytearray()
+        dataFromClient = bytearray()
         try:
-            dataToClient = b''
-            dataFromClient = b''
+            clientSocket.setblocking(0)
+            workerSocket.setblocking(0)
+
+            # Set while the data a side sends to its peer is backed up past the high watermark
+            clientReadPaused = workerReadPaused = False
+            budgetPaused = False
+            # Set once a side has closed. Whatever is still pending for the other side is sent before we close it too.
+            clientClosed = workerClosed = False
             while True:
-                waitingToWrite = []
+                if (clientClosed and not dataFromClient) or (workerClosed and not dataToClient):
+                    break
+
+                # Backpressure: stop reading from a side once its peer has highWatermark bytes pending,
+                #  and start again once that has drained to lowWatermark
+                if clientReadPaused:
+                    clientReadPaused = len(dataFromClient) > lowWatermark
+                elif len(dataFromClient) >= highWatermark:
+                    clientReadPaused = True
+                    bufferLimits.countWatermarkPause()
+
+                if workerReadPaused:
+                    workerReadPaused = len(dataToClient) > lowWatermark
+                elif len(dataToClient) >= highWatermark:
+                    workerReadPaused = True
+                    bufferLimits.countWatermarkPause()
 
+                waitingToRead = []
+                if not clientReadPaused and not clientClosed:
+                    waitingToRead.append(clientSocket)
+                if not workerReadPaused and not workerClosed:
+                    waitingToRead.append(workerSocket)
+
+                if waitingToRead and bufferLimits.isExhausted():
+                    # Every connection on this listener together is at the memory budget
+                    if budgetPaused is False:
+                        budgetPaused = True
+                        bufferLimits.countBudgetPause()
+                    waitingToRead = []
+                else:
+                    budgetPaused = False
+
+                waitingToWrite = []
                 if dataToClient:
                     waitingToWrite.append(clientSocket)
                 if dataFromClient:
                     waitingToWrite.append(workerSocket)
-                
+
+                selectTimeout = .3
+                if byteBuckets and waitingToRead:
+                    throttleTime = waitTimeAll(byteBuckets, throttleChunk)
+                    if throttleTime > 0:
+                        # Throttled: leave the data in the kernel until the buckets refill, rather than buffering it
+                        waitingToRead = []
+                        selectTimeout = min(selectTimeout, max(throttleTime, THROTTLE_MIN_WAIT))
+
+                if tlsSockets:
+                    tlsPending = [sock for sock in tlsSockets if sock in waitingToRead and sock.pending()]
+                    if tlsPending:
+                        selectTimeout = 0
+                else:
+                    tlsPending = None
 
                 try:
-                    (hasDataForRead, readyForWrite, hasError) = select.select( [clientSocket, workerSocket], waitingToWrite, [clientSocket, workerSocket], .3)
+                    (hasDataForRead, readyForWrite, hasError) = select.select( waitingToRead, waitingToWrite, [clientSocket, workerSocket], selectTimeout)
                 except KeyboardInterrupt:
                     break
 
                 if hasError:
                     break
-            
-                if clientSocket in hasDataForRead:
-                    nextData = clientSocket.recv(bufferSize)
-                    if not nextData:
-                        break
-                    dataFromClient += nextData
-
-                if workerSocket in hasDataForRead:
-                    nextData = workerSocket.recv(bufferSize)
-                    if not nextData:
-                        break
-                    dataToClient += nextData
-            
+
+                if tlsPending:
+                    hasDataForRead = list(set(hasDataForRead + tlsPending))
+
+                if probe is not None:
+                    probe.selectWakeups += 1
+
+                if hasDataForRead:
+                    numReadable = len(hasDataForRead)
+                    readAllowance = bufferSize * numReadable
+                    if byteBuckets:
+                        readAllowance = takeFromAll(byteBuckets, readAllowance)
+                        if readAllowance < throttleChunk:
+                            # Another connection sharing a bucket got there first, wait until a whole chunk is available again
+                            for bucket in byteBuckets:
+                                bucket.giveBack(readAllowance)
+                            readAllowance = 0
+                    reserved = bufferLimits.reserve(readAllowance)
+                    if byteBuckets and reserved < readAllowance:
+                        for bucket in byteBuckets:
+                            bucket.giveBack(readAllowance - reserved)
+                    readAllowance = reserved
+
+                    # If both sides are readable, the client gets the larger half and the worker whatever remains
+                    clientReadSize = min(bufferSize, (readAllowance + numReadable - 1) // numReadable)
+
+                    try:
+                        if clientSocket in hasDataForRead and clientReadSize > 0:
+                            nextData = _nonBlockingRecv(clientSocket, clientReadSize)
+                            if nextData is not None:
+                                if not nextData:
+                                    clientClosed = True
+                                dataFromClient += nextData
+                                readAllowance -= len(nextData)
+
+                        if workerSocket in hasDataForRead and readAllowance > 0:
+                            nextData = _nonBlockingRecv(workerSocket, min(bufferSize, readAllowance))
+                            if nextData is not None:
+                                if not nextData:
+                                    workerClosed = True
+                                dataToClient += nextData
+                                readAllowance -= len(nextData)
+                                if probe is not None and 'first_byte' not in probe.times:
+                                    probe.mark('first_byte')
+                    finally:
+                        if readAllowance > 0:
+                            # Return whatever we didn't use
+                            bufferLimits.release(readAllowance)
+                            for bucket in byteBuckets:
+                                bucket.giveBack(readAllowance)
+
                 if workerSocket in readyForWrite:
-                    while dataFromClient:
-                        workerSocket.send(dataFromClient[:bufferSize])
-                        dataFromClient = dataFromClient[bufferSize:]
+                    bufferLimits.release(_nonBlockingSend(workerSocket, dataFromClient, bufferSize))
 
                 if clientSocket in readyForWrite:
-                    while dataToClient:
-                        clientSocket.send(dataToClient[:bufferSize])
-                        dataToClient = dataToClient[bufferSize:]
+                    bufferLimits.release(_nonBlockingSend(clientSocket, dataToClient, bufferSize))
 
         except Exception as e:
             logerr('Error on %s:%d: %s\n' %(self.workerAddr, self.workerPort, str(e)))
+        finally:
+            bufferLimits.release(len(dataToClient) + len(dataFromClient))
+            if probe is not None:
+                probe.finishWorker()
 
         self.closeConnectionsAndExit()
 